@@ -0,0 +1,291 @@
+"""This python file will group the Alchemy webhook activities of the same transaction.
+
+Alchemy may send the activities of a transaction in one webhook or in several, and one webhook may
+carry several transactions. Every activity of a webhook is classified in one pass, then collected
+into a bucket per (network, txn_hash, target wallet), and the bucket is popped as a whole once the
+aggregation window of the transaction ends.
+
+The window adapts to the activities received so far. A transaction whose types already form one of
+the largest merges, or a plain ETH transfer without calldata, is flushed shortly after its last
+activity, other transactions wait for the full window, extended by every new activity up to a cap.
+"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+import cache
+
+# Type sets of the largest merges sent by verify_merge_then_send_notify, no other type is merged
+# into them. A lone normal is not one of them, it often grows into a swap or an NFT purchase, unless
+# it's a plain transfer, see is_plain_transfer.
+terminal_patterns = {frozenset({'normal', 'erc20', 'erc721'}),
+                     frozenset({'normal', 'internal', 'erc20'})}
+
+
+def is_plain_transfer(txns):
+    """Check if the activities of a transaction are a plain ETH transfer, sent without calldata.
+
+    Nothing is called by such a transaction, so it won't grow into a swap or an NFT purchase. Only
+    the activities of the WebSocket know the method id, the ones of the webhooks don't.
+
+    :param list txns: The classified activities of the transaction.
+    :rtype: bool
+    """
+    return {txn['txn_type'] for txn in txns} == {'normal'} \
+        and any(txn['activity'].get('methodId') == '0x' for txn in txns)
+
+
+def classify_activity(activity):
+    """Get the transaction type of an Alchemy activity.
+
+    :param dict activity: One activity of an ADDRESS_ACTIVITY webhook.
+    :return str: normal, internal, erc20 or erc721, None if the type is not supported.
+    """
+    if activity.get('category') == 'internal':
+        return 'internal'
+    if 'erc721TokenId' in activity:
+        return 'erc721'
+    if 'erc1155Metadata' in activity:
+        # TODO(LD): Add support to erc1155 txn
+        return None
+    if activity.get('asset') == 'ETH':
+        return 'normal'
+    if 'asset' in activity or activity.get('category') == 'token':
+        return 'erc20'
+    return None
+
+
+def classify_activities(network, activities, get_notify_tokens):
+    """Classify all activities of an ADDRESS_ACTIVITY webhook in one pass.
+
+    Every activity becomes one transaction per tracked wallet it involves, the notify tokens of
+    every distinct address are looked up only once per webhook.
+
+    :param str network: The network of the webhook. (ETH_MAINNET or ETH_GOERLI)
+    :param list activities: Activities of the webhook.
+    :param get_notify_tokens: Function to get the notify tokens of (network, address).
+    :return list: Transactions with network, txn_hash, txn_type, target, block_num,
+        line_notify_tokens and activity keys.
+    """
+    notify_tokens = {}
+    txns = []
+    for activity in activities:
+        txn_type = classify_activity(activity)
+        if txn_type is None:
+            logging.debug(f'Skipped unsupported activity - {activity}')
+            continue
+        block_num = int(activity['blockNum'], 16)
+        for side in ('fromAddress', 'toAddress'):
+            address = str(activity.get(side)).lower()
+            if address not in notify_tokens:
+                notify_tokens[address] = get_notify_tokens(network, address)
+            if notify_tokens[address]:
+                txns.append({'network': network, 'txn_hash': activity['hash'],
+                             'txn_type': txn_type, 'target': address, 'block_num': block_num,
+                             'line_notify_tokens': notify_tokens[address],
+                             'activity': activity})
+    return txns
+
+
+def format_fast_txn(txn):
+    """Format a filtered transaction from its Alchemy activities only, without calling any api.
+
+    :param dict txn: The filtered transaction, with the activities key.
+    :return dict: Target, block number, transfers and etherscan url of the transaction, used by the
+        fast template of line_notify.send_notify.
+    """
+    if txn['network'] == 'ETH_GOERLI':
+        base_url = 'https://goerli.etherscan.io'
+    else:
+        base_url = 'https://etherscan.io'
+    transfers = []
+    for activity in txn['activities']:
+        if str(activity.get('fromAddress')).lower() == txn['target']:
+            direction = 'Sent'
+        else:
+            direction = 'Received'
+        if 'erc721TokenId' in activity:
+            collection = activity.get('asset') or activity.get('rawContract', {}).get('address')
+            transfers.append(f"{direction}: NFT {collection} #{int(activity['erc721TokenId'], 16)}")
+        elif activity.get('value') is None:
+            # Decimals of the token are unknown, only the token is known
+            asset = activity.get('asset') or activity.get('rawContract', {}).get('address')
+            transfers.append(f"{direction}: {asset} (amount unknown)")
+        else:
+            transfers.append(f"{direction}: {activity['value']} {activity.get('asset')}")
+    # The same transfer may be received by both the webhook and the WebSocket
+    return {'target': txn['target'], 'block_num': txn['block_num'],
+            'transfers': '\n'.join(dict.fromkeys(transfers)),
+            'txn_url': f'{base_url}/tx/{txn["txn_hash"]}'}
+
+
+def get_key(txn):
+    """Get the bucket key of a transaction.
+
+    :param dict txn: The transaction, with network, txn_hash and target keys.
+    :return tuple: (network, txn_hash, target)
+    """
+    return txn['network'], txn['txn_hash'], txn['target']
+
+
+class TxnBucket:
+    """Activities of one transaction waiting to be filtered."""
+
+    def __init__(self):
+        self.created_at = time.monotonic()
+        self.last_arrival = self.created_at
+        self.activities = []
+        self.filtering = False
+        self.changed = asyncio.Event()
+
+    def get_pattern(self):
+        """Get the transaction types received so far, sorted, as the pattern of the bucket.
+
+        :rtype: str
+        """
+        return '+'.join(sorted({txn['txn_type'] for txn in self.activities}))
+
+
+class TxnBuckets:
+    """Buckets of activities keyed by (network, txn_hash, target), with O(1) add and pop.
+
+    Buckets are kept in creation order, so the buckets left behind by a dead filter task are
+    evicted from the oldest once they are older than ttl, or once there are more than maxsize.
+    Keys of popped buckets are remembered for idempotency_ttl, activities of a type that was
+    already flushed are dropped, so a retried webhook never notifies twice.
+    """
+
+    def __init__(self, maxsize=10000, ttl=60, window=2, min_window=0.5, max_window=5,
+                 idempotency_ttl=3600):
+        """Create the buckets.
+
+        :param int maxsize: Max number of buckets to keep.
+        :param float ttl: Seconds before an unpopped bucket is evicted.
+        :param float window: Seconds to wait for more activities after the last one.
+        :param float min_window: Seconds to wait after the last activity of a terminal pattern.
+        :param float max_window: Max seconds to wait since the first activity.
+        :param float idempotency_ttl: Seconds to remember the keys of popped buckets.
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.window = window
+        self.min_window = min_window
+        self.max_window = max_window
+        self.buckets = OrderedDict()
+        self.evicted = 0
+        self.windows = {}
+        self.late_arrivals = {}
+        self.duplicates = 0
+        self.popped = cache.LRUCache(maxsize=maxsize * 10, ttl=idempotency_ttl)
+
+    def add(self, txn):
+        """Add an activity to the bucket of its transaction, create the bucket if not exists.
+
+        A type already flushed for the transaction is a duplicate and dropped. A new type coming
+        after the flush starts a new bucket, so it's still notified on its own.
+
+        :param dict txn: The activity, with network, txn_hash and target keys.
+        :return bool: False if the activity is a duplicate and dropped.
+        """
+        self.evict()
+        key = get_key(txn)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            pattern = self.popped.get(key)
+            if pattern is not None:
+                if txn['txn_type'] in pattern.split('+'):
+                    self.duplicates += 1
+                    return False
+                # A new type came after the transaction was flushed, the window was too short
+                self.late_arrivals[pattern] = self.late_arrivals.get(pattern, 0) + 1
+            bucket = self.buckets[key] = TxnBucket()
+        bucket.activities.append(txn)
+        bucket.last_arrival = time.monotonic()
+        bucket.changed.set()
+        return True
+
+    def get_deadline(self, bucket):
+        """Get the time the window of a bucket ends, by the pattern of its activities.
+
+        :param TxnBucket bucket: The bucket.
+        :return float: The deadline in time.monotonic() seconds.
+        """
+        types = frozenset(txn['txn_type'] for txn in bucket.activities)
+        if types in terminal_patterns or is_plain_transfer(bucket.activities):
+            return bucket.last_arrival + self.min_window
+        return min(bucket.created_at + self.max_window, bucket.last_arrival + self.window)
+
+    async def wait_window(self, key):
+        """Wait until the aggregation window of a transaction ends.
+
+        The deadline is recomputed every time a new activity is added to the bucket.
+
+        :param tuple key: Bucket key of the transaction, see get_key.
+        """
+        bucket = self.buckets.get(key)
+        while bucket is not None:
+            timeout = self.get_deadline(bucket) - time.monotonic()
+            if timeout <= 0:
+                return
+            bucket.changed.clear()
+            try:
+                await asyncio.wait_for(bucket.changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                return
+
+    def claim(self, key):
+        """Mark the bucket of a transaction as being filtered.
+
+        :param tuple key: Bucket key of the transaction, see get_key.
+        :return bool: True only for the first claim of an existing bucket, the caller should start
+            filtering it then.
+        """
+        bucket = self.buckets.get(key)
+        if bucket is None or bucket.filtering:
+            return False
+        bucket.filtering = True
+        return True
+
+    def pop(self, key):
+        """Remove the bucket of a transaction.
+
+        :param tuple key: Bucket key of the transaction, see get_key.
+        :return list: The activities of the transaction, empty if the bucket was evicted.
+        """
+        bucket = self.buckets.pop(key, None)
+        if bucket is None:
+            return []
+        pattern = bucket.get_pattern()
+        count, total = self.windows.get(pattern, (0, 0))
+        self.windows[pattern] = (count + 1, total + time.monotonic() - bucket.created_at)
+        # Remember every type flushed so far, a late bucket doesn't forget the earlier ones
+        flushed = self.popped.get(key)
+        if flushed is not None:
+            pattern = '+'.join(sorted(set(pattern.split('+')) | set(flushed.split('+'))))
+        self.popped.set(key, pattern)
+        return bucket.activities
+
+    def evict(self):
+        """Evict the expired buckets and the oldest buckets over maxsize."""
+        deadline = time.monotonic() - self.ttl
+        while self.buckets:
+            key, bucket = next(iter(self.buckets.items()))
+            if bucket.created_at > deadline and len(self.buckets) < self.maxsize:
+                break
+            del self.buckets[key]
+            self.evicted += 1
+            logging.warning(f'Evicted orphaned txn bucket - {key}')
+
+    def __len__(self):
+        return len(self.buckets)
+
+    def stats(self):
+        """Get the statistics of the buckets.
+
+        :rtype: dict
+        """
+        return {'size': len(self.buckets), 'evicted': self.evicted, 'duplicates': self.duplicates,
+                'windows': {pattern: {'count': count, 'avg_seconds': round(total / count, 3),
+                                      'late_arrivals': self.late_arrivals.get(pattern, 0)}
+                            for pattern, (count, total) in self.windows.items()}}
@@ -1,8 +1,13 @@
+import asyncio
 import http.client
 import logging
+import time
+from datetime import datetime, timezone
 
 import requests
 
+import cache
+import metadata_store
 import utilities as utils
 
 config = utils.read_config()
@@ -10,6 +15,15 @@ webhook_url = config.get('webhook_url')
 
 alchemy_api_key = config.get('alchemy_api_key')
 alchemy_webhook_auth_token = config.get('alchemy_webhook_auth_token')
+async_client = None
+# Seconds before an NFT without media will be fetched again
+nft_negative_cache_ttl = 6 * 60 * 60
+# Asset transfers of recent blocks by (network, block number), shared by every tracked wallet
+block_transfers = cache.LRUCache(maxsize=1000, ttl=60)
+in_flight_blocks = {}
+# Transaction types by the category of asset transfers, erc1155 is not supported yet
+transfer_categories = {'external': 'normal', 'internal': 'internal', 'erc20': 'erc20',
+                       'erc721': 'erc721'}
 
 # Uncomment these lines to see the http request and response headers and body.
 # This is useful for debugging, but will become a security risk in production.
@@ -114,15 +128,302 @@ def get_nft_metadata(contract_address, token_id, token_type='ERC721', goerli=Fal
     :param bool goerli: Whether to use goerli test network.
     :return:
     """
+    url = get_nft_metadata_url(contract_address, token_id, token_type, goerli)
+    headers = {
+        "accept": "application/json"
+    }
+    response = requests.get(url, headers=headers, timeout=10).json()
+    response['nft_image_url'] = parse_nft_image_url(response)
+    return response
+
+
+async def async_get_nft_metadata(contract_address, token_id, token_type='ERC721', goerli=False):
+    """Awaitable version of get_nft_metadata, using the shared async http client.
+
+    :param str contract_address: The address of the NFT contract.
+    :param str token_id: The id of the NFT.
+    :param str token_type: The type of the NFT. ERC721 or ERC1155. Default is ERC721.
+    :param bool goerli: Whether to use goerli test network.
+    :return:
+    """
+    url = get_nft_metadata_url(contract_address, token_id, token_type, goerli)
+    headers = {
+        "accept": "application/json"
+    }
+    response = (await get_async_client().get(url, headers=headers, timeout=10)).json()
+    response['nft_image_url'] = parse_nft_image_url(response)
+    return response
+
+
+def get_nft_metadata_url(contract_address, token_id, token_type='ERC721', goerli=False):
+    """Get the api url of NFT metadata.
+
+    :param str contract_address: The address of the NFT contract.
+    :param str token_id: The id of the NFT.
+    :param str token_type: The type of the NFT. ERC721 or ERC1155. Default is ERC721.
+    :param bool goerli: Whether to use goerli test network.
+    :rtype: str
+    """
     if not goerli:
         url = "https://eth-mainnet.g.alchemy.com/nft/v2/"
     else:
         url = "https://eth-goerli.g.alchemy.com/nft/v2/"
     url += (f"{alchemy_api_key}/getNFTMetadata?contractAddress={contract_address}&tokenId={token_id}"
             f"&tokenType={token_type}&refreshCache=false")
-    headers = {
-        "accept": "application/json"
-    }
-    response = requests.get(url, headers=headers).json()
-    response['nft_image_url'] = response['media'][0]['thumbnail']
-    return response
+    return url
+
+
+def parse_nft_image_url(response):
+    """Parse the thumbnail url of NFT from alchemy NFT metadata.
+
+    :param dict response: NFT metadata.
+    :return str: Thumbnail url, or None if the NFT has no media.
+    """
+    try:
+        return response['media'][0]['thumbnail']
+    except (KeyError, IndexError, TypeError):
+        return None
+
+
+def get_nft_image_url(contract_address, token_id, token_type='ERC721', goerli=False):
+    """Get the image url of an NFT, served from the metadata store when possible.
+
+    NFT metadata is fetched once per network, contract and token id. NFTs without media are
+    cached as well, they will be fetched again after nft_negative_cache_ttl seconds.
+
+    :param str contract_address: The address of the NFT contract.
+    :param str token_id: The id of the NFT.
+    :param str token_type: The type of the NFT. ERC721 or ERC1155. Default is ERC721.
+    :param bool goerli: Whether to use goerli test network.
+    :return str: Thumbnail url, or None if the NFT has no media.
+    """
+    network = utils.get_network(goerli)
+    metadata = metadata_store.get_nft_metadata(network, contract_address, token_id)
+    if not is_nft_metadata_usable(metadata):
+        image_url = get_nft_metadata(contract_address, token_id, token_type,
+                                     goerli)['nft_image_url']
+        metadata = metadata_store.save_nft_metadata(network, contract_address, token_id,
+                                                    image_url)
+    return metadata['image_url']
+
+
+async def async_get_nft_image_url(contract_address, token_id, token_type='ERC721', goerli=False):
+    """Awaitable version of get_nft_image_url.
+
+    :param str contract_address: The address of the NFT contract.
+    :param str token_id: The id of the NFT.
+    :param str token_type: The type of the NFT. ERC721 or ERC1155. Default is ERC721.
+    :param bool goerli: Whether to use goerli test network.
+    :return str: Thumbnail url, or None if the NFT has no media.
+    """
+    network = utils.get_network(goerli)
+    metadata = metadata_store.get_nft_metadata(network, contract_address, token_id)
+    if not is_nft_metadata_usable(metadata):
+        response = await async_get_nft_metadata(contract_address, token_id, token_type, goerli)
+        metadata = metadata_store.save_nft_metadata(network, contract_address, token_id,
+                                                    response['nft_image_url'])
+    return metadata['image_url']
+
+
+def is_nft_metadata_usable(metadata):
+    """Check if saved NFT metadata can be used without fetching again.
+
+    :param dict metadata: Saved NFT metadata, or None if not saved.
+    :rtype: bool
+    """
+    if metadata is None:
+        return False
+    if metadata['image_url'] is None:
+        return time.time() - metadata['fetched_at'] < nft_negative_cache_ttl
+    return True
+
+
+def get_rpc_url(goerli=False):
+    """Get the json-rpc url of alchemy.
+
+    :param bool goerli: Whether to use goerli test network.
+    :rtype: str
+    """
+    if not goerli:
+        return f"https://eth-mainnet.g.alchemy.com/v2/{alchemy_api_key}"
+    return f"https://eth-goerli.g.alchemy.com/v2/{alchemy_api_key}"
+
+
+def get_ws_url(goerli=False):
+    """Get the WebSocket url of alchemy.
+
+    :param bool goerli: Whether to use goerli test network.
+    :rtype: str
+    """
+    if not goerli:
+        return f"wss://eth-mainnet.g.alchemy.com/v2/{alchemy_api_key}"
+    return f"wss://eth-goerli.g.alchemy.com/v2/{alchemy_api_key}"
+
+
+async def async_call_rpc(calls, goerli=False):
+    """Call json-rpc methods of alchemy in one batch request.
+
+    :param list calls: (method, params) of every call.
+    :param bool goerli: Whether to use goerli test network.
+    :return list: Results in the order of the calls.
+    """
+    payload = [{"jsonrpc": "2.0", "id": i, "method": method, "params": params}
+               for i, (method, params) in enumerate(calls)]
+    response = await get_async_client().post(get_rpc_url(goerli), json=payload, timeout=10)
+    response.raise_for_status()
+    results = {}
+    for item in response.json():
+        if 'error' in item:
+            raise Exception(f"An error occurred while calling {calls[item['id']][0]}: "
+                            f"{item['error']}")
+        results[item['id']] = item['result']
+    return [results[i] for i in range(len(calls))]
+
+
+async def async_get_block_transfers(block_number, goerli=False):
+    """Get the asset transfers of a block by hash, for every address at once.
+
+    Concurrent callers of the same block share one request, and the transfers are cached once
+    the block is indexed, so all tracked wallets of a busy block cost a handful of calls.
+
+    :param int block_number: The block number.
+    :param bool goerli: Whether to use goerli test network.
+    :return dict: Lists of asset transfers by transaction hash, empty if not indexed yet.
+    """
+    key = (utils.get_network(goerli), block_number)
+    transfers = block_transfers.get(key)
+    if transfers is not None:
+        return transfers
+    task = in_flight_blocks.get(key)
+    if task is None:
+        task = asyncio.ensure_future(fetch_block_transfers(block_number, goerli))
+        in_flight_blocks[key] = task
+        task.add_done_callback(lambda _: in_flight_blocks.pop(key, None))
+    transfers = await asyncio.shield(task)
+    if transfers:
+        block_transfers.set(key, transfers)
+    return transfers
+
+
+async def fetch_block_transfers(block_number, goerli=False):
+    """Get every page of alchemy_getAssetTransfers within one block.
+
+    :param int block_number: The block number.
+    :param bool goerli: Whether to use goerli test network.
+    :return dict: Lists of asset transfers by transaction hash.
+    """
+    params = {"fromBlock": hex(block_number), "toBlock": hex(block_number),
+              "category": list(transfer_categories), "withMetadata": True,
+              "excludeZeroValue": False, "maxCount": hex(1000)}
+    transfers = {}
+    while True:
+        result, = await async_call_rpc([("alchemy_getAssetTransfers", [params])], goerli)
+        for transfer in result['transfers']:
+            transfers.setdefault(transfer['hash'], []).append(transfer)
+        if not result.get('pageKey'):
+            return transfers
+        params['pageKey'] = result['pageKey']
+
+
+async def async_find_transaction(txn_hash, target_address, txn_types, block_number,
+                                 goerli=False):
+    """Find the rows of a transaction in the asset transfers of its block, in the same format as
+    the etherscan transaction lists.
+
+    Gas isn't part of the transfers, it's read from the transaction and its receipt in one batch
+    request and copied to every row, like the etherscan transaction lists. Token names and decimals are read from the metadata store,
+    like etherscan.async_find_transaction does.
+
+    :param str txn_hash: The hash of the transaction.
+    :param str target_address: The target wallet address.
+    :param set txn_types: Types to find, normal, internal, erc20 or erc721.
+    :param int block_number: The block number of the transaction.
+    :param bool goerli: Whether to use goerli test network.
+    :return dict: Rows of the found types by type, empty if the block is not indexed yet.
+    """
+    # etherscan imports alchemy
+    import etherscan as eth
+
+    target_address = target_address.lower()
+    network = utils.get_network(goerli)
+    rows = {}
+    for transfer in (await async_get_block_transfers(block_number, goerli)).get(txn_hash, []):
+        txn_type = transfer_categories.get(transfer['category'])
+        if txn_type not in txn_types or txn_type in rows \
+                or target_address not in (transfer['from'], str(transfer['to']).lower()):
+            continue
+        metadata = None
+        if txn_type in ('erc20', 'erc721'):
+            contract_address = transfer['rawContract']['address'].lower()
+            metadata = metadata_store.get_token_metadata(network, contract_address)
+            if metadata is None:
+                # Transfers may have no decimals and only know the symbol, so a contract seen for
+                # the first time is found on etherscan, which saves its metadata
+                row = await eth.async_find_transfer_in_block(
+                    txn_hash, target_address,
+                    {'txn_type': txn_type, 'contractAddress': contract_address}, block_number,
+                    goerli=goerli)
+                if row is not None:
+                    rows[txn_type] = row
+                continue
+        rows[txn_type] = parse_asset_transfer(transfer, txn_type, metadata)
+    if rows:
+        txn, receipt = await async_call_rpc([("eth_getTransactionByHash", [txn_hash]),
+                                             ("eth_getTransactionReceipt", [txn_hash])], goerli)
+        gas_price = receipt.get('effectiveGasPrice') or txn['gasPrice']
+        for row in rows.values():
+            row.update({'gasPrice': str(int(gas_price, 16)),
+                        'gasUsed': str(int(receipt['gasUsed'], 16))})
+    if 'normal' in rows:
+        # Transfers don't know the function, its name is known if etherscan listed it before
+        method_id = txn['input'][:10] if len(txn['input']) > 2 else '0x'
+        rows['normal'].update({'contractAddress': receipt.get('contractAddress') or '',
+                               'methodId': method_id,
+                               'functionName': eth.function_names.get(method_id) or ''})
+    return rows
+
+
+def parse_asset_transfer(transfer, txn_type, metadata=None):
+    """Parse an asset transfer into a row in the format of the etherscan transaction lists.
+
+    :param dict transfer: One transfer of alchemy_getAssetTransfers.
+    :param str txn_type: normal, internal, erc20 or erc721.
+    :param dict metadata: Saved metadata of the token of an erc20 or erc721 transfer.
+    :rtype: dict
+    """
+    timestamp = datetime.strptime(transfer['metadata']['blockTimestamp'], '%Y-%m-%dT%H:%M:%S.%fZ')
+    raw_contract = transfer['rawContract']
+    row = {'hash': transfer['hash'], 'blockNumber': str(int(transfer['blockNum'], 16)),
+           'timeStamp': str(int(timestamp.replace(tzinfo=timezone.utc).timestamp())),
+           'from': transfer['from'], 'to': transfer['to'] or '', 'contractAddress': ''}
+    if txn_type in ('normal', 'internal'):
+        row['value'] = str(int(raw_contract['value'] or '0x0', 16))
+    if txn_type == 'erc20':
+        row.update({'contractAddress': raw_contract['address'].lower(),
+                    'value': str(int(raw_contract['value'] or '0x0', 16)),
+                    'tokenSymbol': metadata['symbol'], 'tokenName': metadata['name'],
+                    'tokenDecimal': str(metadata['decimals'])})
+    if txn_type == 'erc721':
+        row.update({'contractAddress': raw_contract['address'].lower(),
+                    'tokenName': metadata['name'],
+                    'tokenID': str(int(transfer['erc721TokenId'], 16))})
+    return row
+
+
+def get_async_client():
+    """Get the shared async http client of alchemy, create one if not exists.
+
+    :rtype: httpx.AsyncClient
+    """
+    global async_client
+    if async_client is None:
+        async_client = utils.create_async_client(10)
+    return async_client
+
+
+async def close_async_client():
+    """Close the shared async http client of alchemy."""
+    global async_client
+    if async_client is not None:
+        await async_client.aclose()
+        async_client = None
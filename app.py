@@ -1,8 +1,10 @@
 """This is the main file of the project."""
 import asyncio
 import logging
+import multiprocessing
 import os
 import time
+from contextlib import asynccontextmanager
 
 import uvicorn
 from fastapi import FastAPI, Request, HTTPException
@@ -14,10 +16,15 @@ from linebot.v3.messaging import Configuration, ApiClient, MessagingApi, ReplyMe
     TemplateMessage, MessageAction, CarouselTemplate
 from linebot.v3.webhooks import MessageEvent, TextMessageContent, FollowEvent
 
+import aggregator
 import alchemy as al
 import etherscan as eth
+import image_processing
+import ingest
 import line_notify
+import registry
 import utilities as utils
+import verifier
 
 os.makedirs('logs', exist_ok=True)
 log_filename = time.strftime("./logs/%Y%m%d_%H%M%S.log")
@@ -26,7 +33,43 @@ logging.basicConfig(filename=f'{log_filename}', encoding='utf-8', filemode='w',
                     datefmt='%d-%b-%Y %H:%M:%S',
                     level=logging.DEBUG, force=True)
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Run the background tasks while the server is up.
+
+    The wallet registry flusher, the webhook ingest workers and the verification poller start with
+    the server, so do the Alchemy WebSocket streams in websocket ingest mode. On shutdown they are
+    stopped, the registry is flushed, webhooks still queued are spilled to disk, and the pooled
+    upstream connections are released.
+    """
+    tasks = [asyncio.create_task(registry.run_flusher()),
+             asyncio.create_task(ingest_queue.run_spill_reader()),
+             asyncio.create_task(verification_poller.run())]
+    tasks.extend(asyncio.create_task(run_ingest_worker())
+                 for _ in range(config['ingest_workers']))
+    if config['ingest_mode'] == 'websocket':
+        import stream
+
+        for network in (eth_mainnet, eth_goerli):
+            alchemy_stream = stream.AlchemyStream(
+                network,
+                config['alchemy_ws_urls'][network] or al.get_ws_url(goerli=network == eth_goerli),
+                ingest_queue.submit,
+                lambda network=network: registry.get_registry().get_tracking_wallets(network))
+            alchemy_streams.append(alchemy_stream)
+            tasks.append(asyncio.create_task(alchemy_stream.run()))
+    yield
+    for task in tasks:
+        task.cancel()
+    registry.get_registry().flush()
+    ingest_queue.spill_queued()
+    await eth.close_async_client()
+    await al.close_async_client()
+    image_processing.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
 origins = ["*"]
 
 app.add_middleware(
@@ -43,8 +86,15 @@ handler = WebhookHandler(config['line_channel_secret'])
 
 eth_mainnet = 'ETH_MAINNET'
 eth_goerli = 'ETH_GOERLI'
-unfiltered_txns = []
-filtering_txns = set()
+txn_buckets = aggregator.TxnBuckets(window=config['aggregation_window'],
+                                     min_window=config['aggregation_min_window'],
+                                     max_window=config['aggregation_max_window'],
+                                     idempotency_ttl=config['idempotency_ttl'])
+alchemy_streams = []
+verification_poller = verifier.VerificationPoller(
+    network_backends=config['verification_backends'], hedge_percentile=config['hedge_percentile'])
+ingest_queue = ingest.IngestQueue(maxsize=config['ingest_queue_size'],
+                                  idempotency_ttl=config['idempotency_ttl'])
 operation_type = {}
 
 
@@ -73,17 +123,34 @@ async def notify(request: Request):
     response_form = await request.form()
     auth_code = response_form['code']
     user_id = response_form['state']
-    notify_token = line_notify.get_notify_token_by_auth_code(auth_code)
+    notify_token = await asyncio.to_thread(line_notify.get_notify_token_by_auth_code, auth_code)
     utils.add_notify_token_by_user_id(user_id, notify_token)
     push_message = f"Successfully connected to Line Notify! \n" \
                    f"You may now press Wallet Management on the menu below\n" \
                    f"Start tracking your Ethereum Wallet.\n"
-    line_notify.send_message(push_message, notify_token)
+    await asyncio.to_thread(line_notify.send_message, push_message, notify_token)
     show_message = f"Successfully connected to LINE Notify! " \
                    f"You may now close this page."
     return show_message
 
 
+@app.get("/stats")
+async def stats():
+    """Show the runtime statistics of the pipeline, such as the etherscan queue depth."""
+    return {'etherscan_scheduler': eth.request_scheduler.stats(),
+            'etherscan_coalesced': eth.coalesced_requests,
+            'balance_cache': eth.balance_cache.stats(),
+            'token_balance_cache': eth.token_balance_cache.stats(),
+            'wallet_registry': registry.get_registry().stats(),
+            'ingest_queue': ingest_queue.stats(),
+            'txn_buckets': txn_buckets.stats(),
+            'verification_poller': verification_poller.stats(),
+            'alchemy_streams': {alchemy_stream.network: alchemy_stream.stats()
+                                for alchemy_stream in alchemy_streams},
+            'etherscan_circuits': {host: breaker.stats()
+                                   for host, breaker in eth.circuit_breakers.items()}}
+
+
 @handler.add(MessageEvent, message=TextMessageContent)
 def handle_message(event):
     with ApiClient(configuration) as api_client:
@@ -107,9 +174,9 @@ def handle_message(event):
             if message_received == 'leave':
                 reply_message = f"Binding process ended!"
                 operation_type.pop(user_id)
-            elif wallet_address.startswith('0x') and len(wallet_address) == 42:
+            elif utils.is_valid_address(wallet_address):
                 notify_token = utils.get_notify_token_by_user_id(user_id)
-                tracking_wallets = utils.get_tracking_wallets(network)
+                is_tracked = bool(utils.get_notify_tokens_by_address(network, wallet_address))
                 user_tracked_wallets = utils.get_tracking_addresses_by_user_id(user_id, network)
 
                 if operation_type[user_id] == 'add':
@@ -117,8 +184,8 @@ def handle_message(event):
                         reply_message = f"Wallet address has already been added before!\n" \
                                         f"Press Get Wallet List Button to see all tracking addresses."
                     else:
-                        if wallet_address not in tracking_wallets:
-                            al.add_tracking_address(tracking_wallets['webhook_id'], wallet_address)
+                        if not is_tracked:
+                            al.add_tracking_address(utils.get_webhook_id(network), wallet_address)
                         utils.add_tracking_wallet(network, wallet_address, notify_token)
                         utils.add_tracking_address_by_user_id(user_id, network, wallet_address)
                         reply_message = f"Successfully added new tracking address!\n" \
@@ -132,8 +199,8 @@ def handle_message(event):
                         reply_message = f"Wallet address not found in tracking list!\n" \
                                         f"Press Get Wallet List Button to see all tracking addresses."
                     else:
-                        if wallet_address in tracking_wallets:
-                            al.remove_tracking_address(tracking_wallets['webhook_id'],
+                        if is_tracked:
+                            al.remove_tracking_address(utils.get_webhook_id(network),
                                                        wallet_address)
                         utils.remove_tracking_wallet(network, wallet_address, notify_token)
                         utils.remove_tracking_address_by_user_id(user_id, network, wallet_address)
@@ -324,7 +391,37 @@ def handle_follow(event):
 
 @app.post('/alchemy')
 async def alchemy(request: Request):
-    json_received = await request.json()
+    """Webhook of Alchemy, queue the payload to be processed by the ingest workers."""
+    try:
+        json_received = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid json.")
+    if not isinstance(json_received, dict) or 'type' not in json_received \
+            or 'event' not in json_received:
+        raise HTTPException(status_code=400, detail="Invalid webhook payload.")
+    if ingest_queue.is_duplicate(json_received.get('id')):
+        logging.debug(f'Dropped duplicate Alchemy webhook - {json_received.get("id")}')
+        return 'OK'
+    if not ingest_queue.submit(json_received):
+        logging.warning('Ingest queue is full, spilled the webhook to disk.')
+    return 'OK'
+
+
+async def run_ingest_worker():
+    """Process the queued Alchemy webhooks one by one, run forever."""
+    while True:
+        json_received = await ingest_queue.get()
+        try:
+            process_alchemy_webhook(json_received)
+        except Exception as e:
+            logging.error(f'Failed to process Alchemy webhook - {e}')
+
+
+def process_alchemy_webhook(json_received: dict):
+    """Classify the activities of an Alchemy webhook, then start filtering its transactions.
+
+    :param dict json_received: The webhook payload.
+    """
     logging.debug(f'Alchemy - {json_received}')
     try:
         if json_received['event']['eventDetails'] == '<EVENT_DETAILS>':
@@ -332,75 +429,42 @@ async def alchemy(request: Request):
     except KeyError:
         pass
     if json_received['type'] == 'ADDRESS_ACTIVITY':
-        txn_network = json_received['event']['network']
-        txn_hash = json_received['event']['activity'][0]['hash']
-        block_num = int(json_received['event']['activity'][0]['blockNum'], 16)
-        tracking_wallets = utils.get_tracking_wallets(txn_network)
-        address_list = [key.lower() for key in tracking_wallets.keys()]
-
-        # Analyze the target wallet address and line notify tokens
-        target = ''
-        line_notify_tokens = []
-        if json_received['event']['activity'][0]['toAddress'] in address_list:
-            target = str(json_received['event']['activity'][0]['toAddress'])
-            line_notify_tokens.extend(tracking_wallets[target])
-        if json_received['event']['activity'][0]['fromAddress'] in address_list:
-            target = str(json_received['event']['activity'][0]['fromAddress'])
-            line_notify_tokens.extend(tracking_wallets[target])
-        line_notify_tokens = list(set(line_notify_tokens))
-
-        # Determine the transaction type and add to unfiltered_txns list
-        if 'asset' in json_received['event']['activity'][0]:
-            if json_received['event']['activity'][0]['category'] == 'internal':  # internal txn
-                logging.debug('adding internal txn')
-                unfiltered_txns.append(
-                    {'network': txn_network, 'txn_hash': txn_hash, 'txn_type': 'internal',
-                     'target': target, 'block_num': block_num,
-                     'line_notify_tokens': line_notify_tokens})
-            elif json_received['event']['activity'][0]['asset'] == 'ETH':  # normal txn
-                logging.debug('adding normal txn')
-                unfiltered_txns.append(
-                    {'network': txn_network, 'txn_hash': txn_hash, 'txn_type': 'normal',
-                     'target': target, 'block_num': block_num,
-                     'line_notify_tokens': line_notify_tokens})
-            else:  # erc20 txn
-                logging.debug('adding erc20 txn')
-                unfiltered_txns.append(
-                    {'network': txn_network, 'txn_hash': txn_hash, 'txn_type': 'erc20',
-                     'target': target, 'block_num': block_num,
-                     'line_notify_tokens': line_notify_tokens})
-        elif 'erc721TokenId' in json_received['event']['activity'][0]:  # erc721 txn
-            logging.debug('adding erc721 txn')
-            unfiltered_txns.append(
-                {'network': txn_network, 'txn_hash': txn_hash, 'txn_type': 'erc721',
-                 'target': target, 'block_num': block_num,
-                 'line_notify_tokens': line_notify_tokens})
-        elif 'erc1155Metadata' in json_received['event']['activity'][0]:  # erc1155 txn
-            logging.debug('adding erc1155 txn')
-            # TODO(LD): Add support to erc1155 txn
-        elif json_received['event']['activity'][0]['category'] == 'token':  # erc20 txn
-            logging.debug('adding erc20 txn')
-            unfiltered_txns.append(
-                {'network': txn_network, 'txn_hash': txn_hash, 'txn_type': 'erc20',
-                 'target': target, 'block_num': block_num,
-                 'line_notify_tokens': line_notify_tokens})
-            if len(json_received['event']['activity']) >= 2:  # erc20 + erc721 txn
-                logging.debug('adding erc721 txn')
-                unfiltered_txns.append(
-                    {'network': txn_network, 'txn_hash': txn_hash, 'txn_type': 'erc721',
-                     'target': target, 'block_num': block_num,
-                     'line_notify_tokens': line_notify_tokens})
+        # Classify all activities, group them by hash and target wallet
+        txns = aggregator.classify_activities(json_received['event']['network'],
+                                              json_received['event']['activity'],
+                                              utils.get_notify_tokens_by_address)
+        txns = [txn for txn in txns if txn_buckets.add(txn)]
+        for txn in txns:
+            logging.debug(f'added {txn["txn_type"]} txn')
 
         # Call filter_txns function to start filtering same hash transactions
-        if txn_hash not in filtering_txns:
-            filtering_txns.add(txn_hash)
-            asyncio.create_task(filter_txns(txn_hash))
+        for key in dict.fromkeys(aggregator.get_key(txn) for txn in txns):
+            if txn_buckets.claim(key):
+                asyncio.create_task(filter_txns(*key))
+
+
+async def verify_and_format_txn(txn: dict, txn_type: str, use_goerli: bool):
+    """Wait for one type of a filtered transaction to be found in etherscan, then format it.
+
+    :param dict txn: The filtered transaction.
+    :param str txn_type: The type to verify.
+    :param bool use_goerli: If True, the transaction is in goerli testnet.
+    :return dict: The formatted transaction.
+    """
+    found_txn = await verification_poller.wait_for(
+        txn['network'], txn['target'], txn['block_num'], txn_type, txn['txn_hash'])
+    formatted_txn = await eth.async_format_txn(found_txn, txn_type, txn['target'],
+                                               goerli=use_goerli)
+    logging.debug(f'Formatted {txn_type} txn - {formatted_txn}')
+    return formatted_txn
 
 
 async def verify_merge_then_send_notify(txn: dict):
     """Verify the transaction from etherscan then send notify to users.
 
-    The function will be run in every 5 seconds when get called by filter_txns function.
+    The function will be called by filter_txns function, and it will wait for the shared
+    verification poller to find every type of the transaction in etherscan. Every type is verified
+    and formatted concurrently.
     While the transaction is found in etherscan, it will be formatted, merged then sent to users.
 
     The input txn should be a filtered transaction, which should be a dictionary with keys:
@@ -413,155 +477,126 @@ async def verify_merge_then_send_notify(txn: dict):
 
     :param dict txn: The filtered transaction.
     """
-    while True:
-        try:
-            normal_txn = {}
-            internal_txn = {}
-            erc721_txn = {}
-            erc20_txn = {}
-            use_goerli = False
-            if txn['network'] == eth_goerli:
-                use_goerli = True
-
-            # Check if the transaction is found in etherscan
-            for txn_type in txn['txn_type']:
-                if txn_type == 'normal':
-                    normal_txns = eth.get_normal_transactions(txn['target'],
-                                                              start_block=txn['block_num'],
-                                                              goerli=use_goerli)
-                    for normal_txn in normal_txns:
-                        if normal_txn['hash'] == txn['txn_hash']:
-                            normal_txn = eth.format_txn(normal_txn, txn_type, txn['target'],
-                                                        goerli=use_goerli)
-                            logging.debug(f'Formatted normal txn - {normal_txn}')
-                            break
-                if txn_type == 'internal':
-                    internal_txns = eth.get_internal_transactions(txn['target'],
-                                                                  start_block=txn['block_num'],
-                                                                  goerli=use_goerli)
-                    for internal_txn in internal_txns:
-                        if internal_txn['hash'] == txn['txn_hash']:
-                            internal_txn = eth.format_txn(internal_txn, txn_type, txn['target'],
-                                                          goerli=use_goerli)
-                            logging.debug(f'Formatted internal txn - {internal_txn}')
-                            break
-                if txn_type == 'erc20':
-                    erc20_txns = eth.get_erc20_token_transfers(txn['target'],
-                                                               start_block=txn['block_num'],
-                                                               goerli=use_goerli)
-                    for erc20_txn in erc20_txns:
-                        if erc20_txn['hash'] == txn['txn_hash']:
-                            erc20_txn = eth.format_txn(erc20_txn, txn_type, txn['target'],
-                                                       goerli=use_goerli)
-                            logging.debug(f'Formatted erc20 txn - {erc20_txn}')
-                            break
-                if txn_type == 'erc721':
-                    erc721_txns = eth.get_erc721_token_transfers(txn['target'],
-                                                                 start_block=txn['block_num'],
-                                                                 goerli=use_goerli)
-                    for erc721_txn in erc721_txns:
-                        if erc721_txn['hash'] == txn['txn_hash']:
-                            erc721_txn = eth.format_txn(erc721_txn, txn_type, txn['target'],
-                                                        goerli=use_goerli)
-                            logging.debug(f'Formatted erc721 txn - {erc721_txn}')
-                            break
-
-            # Merge the transactions and send notify
-            if len(txn['txn_type']) == 1 and txn['txn_type'][0] == 'normal':
-                line_notify.send_notify(normal_txn, 'normal', txn['line_notify_tokens'])
-                logging.info(f'Sent normal txn notify - {txn["txn_hash"]}')
-            elif len(txn['txn_type']) == 1 and txn['txn_type'][0] == 'internal':
-                line_notify.send_notify(internal_txn, 'internal', txn['line_notify_tokens'])
-                logging.info(f'Sent internal txn notify - {txn["txn_hash"]}')
-            elif len(txn['txn_type']) == 1 and txn['txn_type'][0] == 'erc20':
-                erc20_txn['spend_value'] = 'Transfer'
-                line_notify.send_notify(erc20_txn, 'erc20', txn['line_notify_tokens'])
-                logging.info(f'Sent erc20 txn notify - {txn["txn_hash"]}')
-            elif len(txn['txn_type']) == 1 and txn['txn_type'][0] == 'erc721':
-                erc721_txn['spend_value'] = 'Transfer'
-                line_notify.send_notify(erc721_txn, 'erc721', txn['line_notify_tokens'])
-                logging.info(f'Sent erc721 txn notify - {txn["txn_hash"]}')
-
-            elif len(txn['txn_type']) == 2 and 'normal' in txn['txn_type'] and 'erc20' in txn[
-                'txn_type']:
-                new_txn = erc20_txn
-                if normal_txn['value'] == '0':
-                    new_txn['spend_value'] = 'Transfer'
-                else:
-                    new_txn['spend_value'] = f"{normal_txn['eth_value']} ETH"
-                line_notify.send_notify(new_txn, 'erc20', txn['line_notify_tokens'])
-                logging.info(f'Sent normal/erc20 txn notify - {txn["txn_hash"]}')
-            elif len(txn['txn_type']) == 2 and 'normal' in txn['txn_type'] and 'erc721' in txn[
-                'txn_type']:
-                new_txn = normal_txn
-                if normal_txn['value'] == '0':
-                    new_txn['spend_value'] = 'Transfer'
-                else:
-                    new_txn['spend_value'] = f"{normal_txn['eth_value']} ETH"
-                new_txn['to'] = erc721_txn['to']
-                new_txn['token_name'] = erc721_txn['token_name']
-                new_txn['token_id'] = erc721_txn['token_id']
-                new_txn['nft_image_path'] = erc721_txn['nft_image_path']
-                line_notify.send_notify(new_txn, 'erc721', txn['line_notify_tokens'])
-                logging.info(f'Sent normal/erc721 txn notify - {txn["txn_hash"]}')
-            elif len(txn['txn_type']) == 2 and 'erc20' in txn['txn_type'] and 'erc721' in txn[
-                'txn_type']:
-                new_txn = erc20_txn
-                new_txn['token_name'] = erc721_txn['token_name']
-                new_txn['token_id'] = erc721_txn['token_id']
-                new_txn['nft_image_path'] = erc721_txn['nft_image_path']
-                line_notify.send_notify(new_txn, 'erc20_721', txn['line_notify_tokens'])
-                logging.info(f'Sent erc20/erc721 txn notify - {txn["txn_hash"]}')
-            elif len(txn['txn_type']) == 2 and 'internal' in txn['txn_type'] and 'erc721' in txn[
-                'txn_type']:
-                new_txn = erc721_txn
-                new_txn['receive_value'] = f"{internal_txn['eth_value']} ETH"
-                line_notify.send_notify(new_txn, 'internal_721', txn['line_notify_tokens'])
-                logging.info(f'Sent internal/erc721 txn notify - {txn["txn_hash"]}')
-            elif len(txn['txn_type']) == 2 and 'normal' in txn['txn_type'] and 'internal' in txn[
-                'txn_type']:
-                new_txn = normal_txn
-                new_txn['receive_value'] = f"{internal_txn['eth_value']} ETH"
-                line_notify.send_notify(new_txn, 'normal_internal', txn['line_notify_tokens'])
-                logging.info(f'Sent normal/internal txn notify - {txn["txn_hash"]}')
-
-            elif len(txn['txn_type']) == 3 and 'normal' in txn['txn_type'] and 'erc20' in txn[
-                'txn_type'] and 'erc721' in txn['txn_type']:
-                new_txn = erc721_txn
+    try:
+        use_goerli = False
+        if txn['network'] == eth_goerli:
+            use_goerli = True
+
+        # Wait for every type of the transaction to be found in etherscan and formatted
+        formatted_txns = dict(zip(txn['txn_type'], await asyncio.gather(
+            *(verify_and_format_txn(txn, txn_type, use_goerli) for txn_type in txn['txn_type']))))
+        normal_txn = formatted_txns.get('normal', {})
+        internal_txn = formatted_txns.get('internal', {})
+        erc20_txn = formatted_txns.get('erc20', {})
+        erc721_txn = formatted_txns.get('erc721', {})
+
+        # Merge the transactions and send notify
+        if len(txn['txn_type']) == 1 and txn['txn_type'][0] == 'normal':
+            await asyncio.to_thread(line_notify.send_notify, normal_txn, 'normal',
+                                    txn['line_notify_tokens'])
+            logging.info(f'Sent normal txn notify - {txn["txn_hash"]}')
+        elif len(txn['txn_type']) == 1 and txn['txn_type'][0] == 'internal':
+            await asyncio.to_thread(line_notify.send_notify, internal_txn, 'internal',
+                                    txn['line_notify_tokens'])
+            logging.info(f'Sent internal txn notify - {txn["txn_hash"]}')
+        elif len(txn['txn_type']) == 1 and txn['txn_type'][0] == 'erc20':
+            erc20_txn['spend_value'] = 'Transfer'
+            await asyncio.to_thread(line_notify.send_notify, erc20_txn, 'erc20',
+                                    txn['line_notify_tokens'])
+            logging.info(f'Sent erc20 txn notify - {txn["txn_hash"]}')
+        elif len(txn['txn_type']) == 1 and txn['txn_type'][0] == 'erc721':
+            erc721_txn['spend_value'] = 'Transfer'
+            await asyncio.to_thread(line_notify.send_notify, erc721_txn, 'erc721',
+                                    txn['line_notify_tokens'])
+            logging.info(f'Sent erc721 txn notify - {txn["txn_hash"]}')
+
+        elif len(txn['txn_type']) == 2 and 'normal' in txn['txn_type'] and 'erc20' in txn[
+            'txn_type']:
+            new_txn = erc20_txn
+            if normal_txn['value'] == '0':
+                new_txn['spend_value'] = 'Transfer'
+            else:
                 new_txn['spend_value'] = f"{normal_txn['eth_value']} ETH"
-                new_txn['action'] = normal_txn['action']
-                new_txn['erc20_value'] = erc20_txn['value']
-                new_txn['token_symbol'] = erc20_txn['token_symbol']
-                new_txn['token_balance'] = erc20_txn['token_balance']
-                line_notify.send_notify(new_txn, 'normal_20_721', txn['line_notify_tokens'])
-                logging.info(f'Sent normal/erc20/erc721 txn notify - {txn["txn_hash"]}')
-            elif len(txn['txn_type']) == 3 and 'normal' in txn['txn_type'] and 'internal' in txn[
-                'txn_type'] and 'erc20' in txn['txn_type']:
-                new_txn = erc20_txn
-                new_txn['receive_value'] = f"{internal_txn['eth_value']} ETH"
-                line_notify.send_notify(new_txn, 'normal_internal_20', txn['line_notify_tokens'])
-                logging.info(f'Sent normal/internal/erc20 txn notify - {txn["txn_hash"]}')
-
-            break
-        except TypeError:
-            # Transaction not found in etherscan, wait 5 seconds and try again
-            await asyncio.sleep(5)
-            continue
-        except Exception as e:
-            logging.error(f'Error occurred while merging txn: {e}')
-            break
-
-
-async def filter_txns(txn_hash: str):
+            await asyncio.to_thread(line_notify.send_notify, new_txn, 'erc20',
+                                    txn['line_notify_tokens'])
+            logging.info(f'Sent normal/erc20 txn notify - {txn["txn_hash"]}')
+        elif len(txn['txn_type']) == 2 and 'normal' in txn['txn_type'] and 'erc721' in txn[
+            'txn_type']:
+            new_txn = normal_txn
+            if normal_txn['value'] == '0':
+                new_txn['spend_value'] = 'Transfer'
+            else:
+                new_txn['spend_value'] = f"{normal_txn['eth_value']} ETH"
+            new_txn['to'] = erc721_txn['to']
+            new_txn['token_name'] = erc721_txn['token_name']
+            new_txn['token_id'] = erc721_txn['token_id']
+            new_txn['nft_image_path'] = erc721_txn['nft_image_path']
+            await asyncio.to_thread(line_notify.send_notify, new_txn, 'erc721',
+                                    txn['line_notify_tokens'])
+            logging.info(f'Sent normal/erc721 txn notify - {txn["txn_hash"]}')
+        elif len(txn['txn_type']) == 2 and 'erc20' in txn['txn_type'] and 'erc721' in txn[
+            'txn_type']:
+            new_txn = erc20_txn
+            new_txn['token_name'] = erc721_txn['token_name']
+            new_txn['token_id'] = erc721_txn['token_id']
+            new_txn['nft_image_path'] = erc721_txn['nft_image_path']
+            await asyncio.to_thread(line_notify.send_notify, new_txn, 'erc20_721',
+                                    txn['line_notify_tokens'])
+            logging.info(f'Sent erc20/erc721 txn notify - {txn["txn_hash"]}')
+        elif len(txn['txn_type']) == 2 and 'internal' in txn['txn_type'] and 'erc721' in txn[
+            'txn_type']:
+            new_txn = erc721_txn
+            new_txn['receive_value'] = f"{internal_txn['eth_value']} ETH"
+            await asyncio.to_thread(line_notify.send_notify, new_txn, 'internal_721',
+                                    txn['line_notify_tokens'])
+            logging.info(f'Sent internal/erc721 txn notify - {txn["txn_hash"]}')
+        elif len(txn['txn_type']) == 2 and 'normal' in txn['txn_type'] and 'internal' in txn[
+            'txn_type']:
+            new_txn = normal_txn
+            new_txn['receive_value'] = f"{internal_txn['eth_value']} ETH"
+            await asyncio.to_thread(line_notify.send_notify, new_txn, 'normal_internal',
+                                    txn['line_notify_tokens'])
+            logging.info(f'Sent normal/internal txn notify - {txn["txn_hash"]}')
+
+        elif len(txn['txn_type']) == 3 and 'normal' in txn['txn_type'] and 'erc20' in txn[
+            'txn_type'] and 'erc721' in txn['txn_type']:
+            new_txn = erc721_txn
+            new_txn['spend_value'] = f"{normal_txn['eth_value']} ETH"
+            new_txn['action'] = normal_txn['action']
+            new_txn['erc20_value'] = erc20_txn['value']
+            new_txn['token_symbol'] = erc20_txn['token_symbol']
+            new_txn['token_balance'] = erc20_txn['token_balance']
+            await asyncio.to_thread(line_notify.send_notify, new_txn, 'normal_20_721',
+                                    txn['line_notify_tokens'])
+            logging.info(f'Sent normal/erc20/erc721 txn notify - {txn["txn_hash"]}')
+        elif len(txn['txn_type']) == 3 and 'normal' in txn['txn_type'] and 'internal' in txn[
+            'txn_type'] and 'erc20' in txn['txn_type']:
+            new_txn = erc20_txn
+            new_txn['receive_value'] = f"{internal_txn['eth_value']} ETH"
+            await asyncio.to_thread(line_notify.send_notify, new_txn, 'normal_internal_20',
+                                    txn['line_notify_tokens'])
+            logging.info(f'Sent normal/internal/erc20 txn notify - {txn["txn_hash"]}')
+
+    except TimeoutError as e:
+        logging.error(f'Gave up verifying txn {txn["txn_hash"]}: {e}')
+    except Exception as e:
+        logging.error(f'Error occurred while merging txn: {e}')
+
+
+async def filter_txns(network: str, txn_hash: str, target: str):
     """Filter transactions' types then send them to verify_merge_then_send_notify function.
 
-    This function will be called only one time per transaction hash.
-    By waiting 2 seconds, the function will be expected to receive are all types of transactions from
-    Alchemy Webhook, then it will filter the transactions' types and send them to
-    verify_merge_then_send_notify function.
-
-    The unfiltered_txns should be updated while receiving new transactions from Alchemy Webhook.
-    And the unfiltered_txns should be a list of dictionary with keys:
+    This function will be called only one time per transaction hash and target wallet.
+    By waiting the aggregation window, the function will be expected to receive all types of
+    transactions from Alchemy Webhook, then it will filter the transactions' types and send them to
+    verify_merge_then_send_notify function. The window ends shortly after the last activity once the
+    types form one of the largest merges or a plain ETH transfer, otherwise it's extended by new
+    activities up to a cap.
+    In fast mode, a notification built from the Alchemy activities is sent first, and the verified
+    one follows as a follow-up if fast_notify_followup is enabled.
+
+    The bucket of the transaction in txn_buckets should be updated while receiving new
+    transactions from Alchemy Webhook. And every transaction in it should be a dictionary with keys:
     - network: The network of the transaction.
     - block_num: The block number of the transaction.
     - target: The target wallet address of the transaction.
@@ -569,33 +604,44 @@ async def filter_txns(txn_hash: str):
     - txn_type: The type of the transaction.
     - line_notify_tokens(list): The line notify tokens to send.
 
+    :param str network: The network of the transaction.
     :param str txn_hash: The hash of the transaction.
+    :param str target: The target wallet address of the transaction.
     """
     # Waiting Alchemy Webhook to send all types of transactions
-    await asyncio.sleep(2)
+    key = (network, txn_hash, target)
+    await txn_buckets.wait_window(key)
 
     # Filter the transactions' types, combine them into one
-    global unfiltered_txns
-    filtered_txn = {}
-    for txn in unfiltered_txns:
-        if txn['txn_hash'] == txn_hash:
-            if not filtered_txn:
-                filtered_txn = {
-                    'txn_hash': txn['txn_hash'],
-                    'network': txn['network'],
-                    'block_num': txn['block_num'],
-                    'target': txn['target'],
-                    'txn_type': [txn['txn_type']],
-                    'line_notify_tokens': txn['line_notify_tokens']
-                }
-            else:
-                filtered_txn['txn_type'].append(txn['txn_type'])
+    txns = txn_buckets.pop(key)
+    if not txns:
+        logging.warning(f'Bucket of {txn_hash} was evicted before filtering.')
+        return
+    filtered_txn = {
+        'txn_hash': txns[0]['txn_hash'],
+        'network': txns[0]['network'],
+        'block_num': txns[0]['block_num'],
+        'target': txns[0]['target'],
+        'txn_type': list(dict.fromkeys(txn['txn_type'] for txn in txns)),
+        'line_notify_tokens': txns[0]['line_notify_tokens'],
+        'activities': [txn['activity'] for txn in txns]
+    }
+    logging.debug(f'Filtered - {filtered_txn}')
+
+    # In fast mode, notify from the Alchemy activities right away
+    if config['notify_mode'] == 'fast':
+        try:
+            await asyncio.to_thread(line_notify.send_notify,
+                                    aggregator.format_fast_txn(filtered_txn), 'fast',
+                                    filtered_txn['line_notify_tokens'])
+            logging.info(f'Sent fast txn notify - {txn_hash}')
+        except Exception as e:
+            logging.error(f'Error occurred while sending fast notify: {e}')
+        if not config['fast_notify_followup']:
+            return
 
     # Finish filtering, call verify_merge_then_send_notify function
-    logging.debug(f'Filtered - {filtered_txn}')
     asyncio.create_task(verify_merge_then_send_notify(filtered_txn))
-    unfiltered_txns = [d for d in unfiltered_txns if d.get('txn_hash') != txn_hash]
-    filtering_txns.remove(txn_hash)
 
 
 def open_rich_menu():
@@ -636,6 +682,7 @@ def open_rich_menu():
 
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()
     utils.initial_checks()
     open_rich_menu()
     uvicorn.run(app, port=config['webhook_port'])
@@ -0,0 +1,135 @@
+"""This python file will keep the results of upstream api calls in memory."""
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Least recently used cache with time to live.
+
+    When the cache is full, the least recently used key will be evicted. Keys expire ttl seconds
+    after they were set, None ttl means never expire.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        """Create a LRU cache.
+
+        :param int maxsize: Max number of keys to keep.
+        :param float ttl: Seconds before a key expires, default is never.
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """Get the value of a key, mark it as recently used.
+
+        :param key: Key to get.
+        :param default: Value to return if the key is not found or expired.
+        """
+        entry = self.data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        expires_at, value = entry
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self.data[key]
+            self.misses += 1
+            return default
+        self.data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        """Set the value of a key, evict the least recently used key if the cache is full.
+
+        :param key: Key to set.
+        :param value: Value to set.
+        :param float ttl: Seconds before the key expires, default is the ttl of the cache.
+        """
+        ttl = ttl if ttl is not None else self.ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        self.data[key] = (expires_at, value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """Remove a key and return its value.
+
+        :param key: Key to remove.
+        :param default: Value to return if the key is not found.
+        """
+        entry = self.data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __len__(self):
+        return len(self.data)
+
+    def stats(self):
+        """Get the statistics of the cache.
+
+        :rtype: dict
+        """
+        return {'size': len(self.data), 'hits': self.hits, 'misses': self.misses}
+
+
+class BlockCache:
+    """Cache of values which change by blocks, such as wallet balances.
+
+    Every value is saved with the block number it was seen at. Asking a key at a newer block
+    than the saved one invalidates the value, asking at the same or an older block is a hit.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        """Create a block cache.
+
+        :param int maxsize: Max number of keys to keep.
+        :param float ttl: Seconds before a key expires, default is never.
+        """
+        self.cache = LRUCache(maxsize, ttl)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, block_number):
+        """Get the value of a key seen at block_number or newer.
+
+        :param key: Key to get.
+        :param int block_number: Block number the value is asked at.
+        :return: The value, or None if not cached.
+        """
+        entry = self.cache.get(key)
+        if entry is not None and entry[0] < block_number:
+            self.cache.pop(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, block_number, value):
+        """Set the value of a key seen at block_number, older values never replace newer ones.
+
+        :param key: Key to set.
+        :param int block_number: Block number the value is seen at.
+        :param value: Value to set.
+        """
+        entry = self.cache.data.get(key)
+        if entry is not None and entry[1][0] > block_number:
+            return
+        self.cache.set(key, (block_number, value))
+
+    def __len__(self):
+        return len(self.cache)
+
+    def stats(self):
+        """Get the statistics of the cache.
+
+        :rtype: dict
+        """
+        return {'size': len(self.cache), 'hits': self.hits, 'misses': self.misses}
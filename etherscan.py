@@ -1,22 +1,46 @@
 """This python file will call etherscan api to get info's of wallets."""
+import asyncio
+import copy
+import json
+import logging
 import time
 from datetime import datetime
+from urllib.parse import urlsplit, parse_qsl, urlencode, urlunsplit
 
+import httpx
 import requests
 from requests import JSONDecodeError
 
 import alchemy
+import cache
+import image_cache
+import image_processing
+import metadata_store
+import resilience
+import scheduler
 import utilities as utils
 
 config = utils.read_config()
 headers = {
     'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_5) AppleWebKit/537.36 (KHTML, like '
                   'Gecko) Chrome/50.0.2661.102 Safari/537.36'}
+async_client = None
+request_scheduler = scheduler.RequestScheduler(config.get('etherscan_rate_limit'))
+circuit_breakers = {}
+in_flight_requests = {}
+coalesced_requests = 0
+balance_cache = cache.BlockCache(maxsize=10000, ttl=300)
+token_balance_cache = cache.BlockCache(maxsize=50000, ttl=300)
+block_timestamps = cache.LRUCache(maxsize=10000)
+# Function names of the listed normal transactions by method id
+function_names = cache.LRUCache(maxsize=10000)
+# keccak256 of Transfer(address,address,uint256), shared by erc20 and erc721
+transfer_topic = '0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef'
 
 
 def get_api_url(module, action, api_key=config.get('etherscan_api_key'), goerli=False, address=None,
                 start_block=None, end_block=None, sort=None, page=None, offset=None,
-                contract_address=None, tag=None):
+                contract_address=None, tag=None, txhash=None, boolean=None):
     if goerli:
         url = f'https://api-goerli.etherscan.io/api?module={module}&action={action}&apikey={api_key}'
     else:
@@ -38,6 +62,10 @@ def get_api_url(module, action, api_key=config.get('etherscan_api_key'), goerli=
         url += f'&contractaddress={contract_address}'
     if tag:
         url += f'&tag={tag}'
+    if txhash:
+        url += f'&txhash={txhash}'
+    if boolean:
+        url += f'&boolean={boolean}'
 
     return url
 
@@ -49,7 +77,25 @@ def get_eth_price(goerli=False):
     :rtype: float
     """
     url = get_api_url('stats', 'ethprice', goerli=goerli)
-    response = get_json_response(url)
+    return parse_eth_price(get_json_response(url))
+
+
+async def async_get_eth_price(goerli=False):
+    """Awaitable version of get_eth_price.
+
+    :param bool goerli: If True, use goerli testnet, default is False
+    :rtype: float
+    """
+    url = get_api_url('stats', 'ethprice', goerli=goerli)
+    return parse_eth_price(await async_get_json_response(url, scheduler.PRIORITY_ENRICH))
+
+
+def parse_eth_price(response):
+    """Parse ETH price from etherscan response.
+
+    :param dict response: Json response of ethprice api
+    :rtype: float
+    """
     if response['status'] == '1' and response['message'] == 'OK':
         eth_price = float(response['result']['ethusd'])
         return eth_price
@@ -66,7 +112,48 @@ def get_wallet_balance(wallet_address, goerli=False, tag='latest'):
     :rtype: dict
     """
     url = get_api_url('account', 'balance', goerli=goerli, address=wallet_address, tag=tag)
-    response = get_json_response(url)
+    return parse_wallet_balance(get_json_response(url))
+
+
+async def async_get_wallet_balance(wallet_address, goerli=False, tag='latest',
+                                   priority=scheduler.PRIORITY_ENRICH):
+    """Awaitable version of get_wallet_balance.
+
+    :param str wallet_address: Wallet address
+    :param bool goerli: If True, use goerli testnet, default is False
+    :param str tag: Pre-defined block parameter, either earliest, pending or latest, default is latest
+    :param int priority: Scheduling priority of the call, default is enrichment
+    :rtype: dict
+    """
+    url = get_api_url('account', 'balance', goerli=goerli, address=wallet_address, tag=tag)
+    return parse_wallet_balance(await async_get_json_response(url, priority))
+
+
+async def async_get_cached_wallet_balance(wallet_address, block_number, goerli=False):
+    """Get wallet balance seen at block_number or newer, served from memory when possible.
+
+    The balance is cached by network, address and block number. A lookup at a newer block of the
+    same address refetches the balance, so the cache never goes back in time.
+
+    :param str wallet_address: Wallet address
+    :param int block_number: Block number of the event asking for the balance
+    :param bool goerli: If True, use goerli testnet, default is False
+    :rtype: dict
+    """
+    key = (utils.get_network(goerli), wallet_address.lower())
+    balance = balance_cache.get(key, block_number)
+    if balance is None:
+        balance = await async_get_wallet_balance(wallet_address, goerli=goerli)
+        balance_cache.set(key, block_number, balance)
+    return balance
+
+
+def parse_wallet_balance(response):
+    """Parse wallet balance from etherscan response.
+
+    :param dict response: Json response of balance api
+    :rtype: dict
+    """
     if response['status'] == '1' and response['message'] == 'OK':
         balance_in_wei = int(response['result'])
         balance_in_eth = balance_in_wei / 10 ** 18
@@ -91,7 +178,78 @@ def get_erc20_token_balance(wallet_address, contract_address, token_decimal, goe
     """
     url = get_api_url('account', 'tokenbalance', goerli=goerli, address=wallet_address,
                       contract_address=contract_address, tag=tag)
-    response = get_json_response(url)
+    return parse_erc20_token_balance(get_json_response(url), token_decimal)
+
+
+async def async_get_erc20_token_balance(wallet_address, contract_address, token_decimal,
+                                        goerli=False, tag='latest',
+                                        priority=scheduler.PRIORITY_ENRICH):
+    """Awaitable version of get_erc20_token_balance.
+
+    :param str wallet_address: Wallet address
+    :param str contract_address: Contract address
+    :param int token_decimal: Token decimal
+    :param bool goerli: If True, use goerli testnet, default is False
+    :param str tag: Pre-defined block parameter, either earliest, pending or latest, default is latest
+    :param int priority: Scheduling priority of the call, default is enrichment
+    :rtype: dict
+    """
+    url = get_api_url('account', 'tokenbalance', goerli=goerli, address=wallet_address,
+                      contract_address=contract_address, tag=tag)
+    return parse_erc20_token_balance(await async_get_json_response(url, priority),
+                                     token_decimal)
+
+
+async def async_get_cached_erc20_token_balance(wallet_address, contract_address, token_decimal,
+                                               block_number, goerli=False):
+    """Get ERC20 token balance seen at block_number or newer, served from memory when possible.
+
+    Works the same as async_get_cached_wallet_balance, cached by network, wallet address,
+    contract address and block number.
+
+    :param str wallet_address: Wallet address
+    :param str contract_address: Contract address
+    :param int token_decimal: Token decimal
+    :param int block_number: Block number of the event asking for the balance
+    :param bool goerli: If True, use goerli testnet, default is False
+    :rtype: dict
+    """
+    key = (utils.get_network(goerli), wallet_address.lower(), contract_address.lower())
+    balance = token_balance_cache.get(key, block_number)
+    if balance is None:
+        balance = await async_get_erc20_token_balance(wallet_address, contract_address,
+                                                      token_decimal, goerli=goerli)
+        token_balance_cache.set(key, block_number, balance)
+    return balance
+
+
+def get_token_metadata(txn, goerli=False):
+    """Get the metadata of the token of an erc20 transfer.
+
+    The metadata is parsed from the transfer and saved at the first time the contract is seen,
+    then it's always read from the metadata store.
+
+    :param dict txn: ERC20 transfer
+    :param bool goerli: If True, use goerli testnet, default is False
+    :return dict: Symbol, decimals and name of the token
+    """
+    network = utils.get_network(goerli)
+    metadata = metadata_store.get_token_metadata(network, txn['contractAddress'])
+    if metadata is None:
+        metadata = metadata_store.save_token_metadata(network, txn['contractAddress'],
+                                                      txn['tokenSymbol'],
+                                                      int(txn['tokenDecimal']),
+                                                      txn['tokenName'])
+    return metadata
+
+
+def parse_erc20_token_balance(response, token_decimal):
+    """Parse ERC20 token balance from etherscan response.
+
+    :param dict response: Json response of tokenbalance api
+    :param int token_decimal: Token decimal
+    :rtype: dict
+    """
     if response['status'] == '1' and response['message'] == 'OK':
         balance_in_wei = int(response['result'])
         balance_converted = balance_in_wei / 10 ** token_decimal
@@ -120,14 +278,26 @@ def get_normal_transactions(wallet_address, goerli=False, start_block=0, end_blo
     url = get_api_url('account', 'txlist', goerli=goerli, address=wallet_address,
                       start_block=start_block, end_block=end_block, page=page, offset=offset,
                       sort=sort)
-    response = get_json_response(url)
-    if response['status'] == '1' and response['message'] == 'OK':
-        return response['result']
-    elif response['message'] == 'No transactions found':
-        return None
-    else:
-        raise Exception(
-            f"An error occurred while getting normal transactions: {response}")
+    return parse_transactions(get_json_response(url), 'normal transactions')
+
+
+async def async_get_normal_transactions(wallet_address, goerli=False, start_block=0,
+                                        end_block=99999999, page=1, offset=10, sort='desc'):
+    """Awaitable version of get_normal_transactions.
+
+    :param str wallet_address: Wallet address
+    :param bool goerli: If True, use goerli testnet, default is False
+    :param int start_block: Start block, default is 0
+    :param int end_block: End block, default is 99999999
+    :param int page: Page, default is 1
+    :param int offset: The number of transactions displayed per page, default is 10
+    :param str sort: Sorting preference, asc or desc, default is desc
+    :rtype: list
+    """
+    url = get_api_url('account', 'txlist', goerli=goerli, address=wallet_address,
+                      start_block=start_block, end_block=end_block, page=page, offset=offset,
+                      sort=sort)
+    return parse_transactions(await async_get_json_response(url), 'normal transactions')
 
 
 def get_internal_transactions(wallet_address, goerli=False, start_block=0, end_block=99999999,
@@ -147,14 +317,26 @@ def get_internal_transactions(wallet_address, goerli=False, start_block=0, end_b
     url = get_api_url('account', 'txlistinternal', goerli=goerli, address=wallet_address,
                       start_block=start_block, end_block=end_block, page=page, offset=offset,
                       sort=sort)
-    response = get_json_response(url)
-    if response['status'] == '1' and response['message'] == 'OK':
-        return response['result']
-    elif response['message'] == 'No transactions found':
-        return None
-    else:
-        raise Exception(
-            f"An error occurred while getting internal transactions: {response}")
+    return parse_transactions(get_json_response(url), 'internal transactions')
+
+
+async def async_get_internal_transactions(wallet_address, goerli=False, start_block=0,
+                                          end_block=99999999, page=1, offset=10, sort='desc'):
+    """Awaitable version of get_internal_transactions.
+
+    :param str wallet_address: Wallet address
+    :param bool goerli: If True, use goerli testnet, default is False
+    :param int start_block: Start block, default is 0
+    :param int end_block: End block, default is 99999999
+    :param int page: Page, default is 1
+    :param int offset: The number of transactions displayed per page, default is 10
+    :param str sort: Sorting preference, asc or desc, default is desc
+    :rtype: list
+    """
+    url = get_api_url('account', 'txlistinternal', goerli=goerli, address=wallet_address,
+                      start_block=start_block, end_block=end_block, page=page, offset=offset,
+                      sort=sort)
+    return parse_transactions(await async_get_json_response(url), 'internal transactions')
 
 
 def get_erc20_token_transfers(wallet_address, goerli=False, contract_address=None, start_block=0,
@@ -174,14 +356,28 @@ def get_erc20_token_transfers(wallet_address, goerli=False, contract_address=Non
     url = get_api_url('account', 'tokentx', goerli=goerli, address=wallet_address,
                       contract_address=contract_address, start_block=start_block,
                       end_block=end_block, page=page, offset=offset, sort=sort)
-    response = get_json_response(url)
-    if response['status'] == '1' and response['message'] == 'OK':
-        return response['result']
-    elif response['message'] == 'No transactions found':
-        return None
-    else:
-        raise Exception(
-            f"An error occurred while getting erc20 token transfers: {response}")
+    return parse_transactions(get_json_response(url), 'erc20 token transfers')
+
+
+async def async_get_erc20_token_transfers(wallet_address, goerli=False, contract_address=None,
+                                          start_block=0, end_block=99999999, page=1, offset=10,
+                                          sort='desc'):
+    """Awaitable version of get_erc20_token_transfers.
+
+    :param str wallet_address: Wallet address
+    :param bool goerli: If True, use goerli testnet, default is False
+    :param str contract_address: Specify token contract address, default is all erc20 tokens
+    :param int start_block: Start block, default is 0
+    :param int end_block: End block, default is 99999999
+    :param int page: Page, default is 1
+    :param int offset: The number of transactions displayed per page, default is 10
+    :param str sort: Sorting preference, asc or desc, default is desc
+    :rtype: list
+    """
+    url = get_api_url('account', 'tokentx', goerli=goerli, address=wallet_address,
+                      contract_address=contract_address, start_block=start_block,
+                      end_block=end_block, page=page, offset=offset, sort=sort)
+    return parse_transactions(await async_get_json_response(url), 'erc20 token transfers')
 
 
 def get_erc721_token_transfers(wallet_address, goerli=False, contract_address=None, start_block=0,
@@ -201,14 +397,28 @@ def get_erc721_token_transfers(wallet_address, goerli=False, contract_address=No
     url = get_api_url('account', 'tokennfttx', goerli=goerli, address=wallet_address,
                       contract_address=contract_address, start_block=start_block,
                       end_block=end_block, page=page, offset=offset, sort=sort)
-    response = get_json_response(url)
-    if response['status'] == '1' and response['message'] == 'OK':
-        return response['result']
-    elif response['message'] == 'No transactions found':
-        return None
-    else:
-        raise Exception(
-            f"An error occurred while getting erc721 token transfers: {response}")
+    return parse_transactions(get_json_response(url), 'erc721 token transfers')
+
+
+async def async_get_erc721_token_transfers(wallet_address, goerli=False, contract_address=None,
+                                           start_block=0, end_block=99999999, page=1, offset=10,
+                                           sort='desc'):
+    """Awaitable version of get_erc721_token_transfers.
+
+    :param str wallet_address: Wallet address
+    :param bool goerli: If True, use goerli testnet, default is False
+    :param str contract_address: Specify token contract address, default is all erc721 tokens
+    :param int start_block: Start block, default is 0
+    :param int end_block: End block, default is 99999999
+    :param int page: Page, default is 1
+    :param int offset: The number of transactions displayed per page, default is 10
+    :param str sort: Sorting preference, asc or desc, default is desc
+    :rtype: list
+    """
+    url = get_api_url('account', 'tokennfttx', goerli=goerli, address=wallet_address,
+                      contract_address=contract_address, start_block=start_block,
+                      end_block=end_block, page=page, offset=offset, sort=sort)
+    return parse_transactions(await async_get_json_response(url), 'erc721 token transfers')
 
 
 def get_erc1155_token_transfers(wallet_address, contract_address=None, start_block=0,
@@ -230,33 +440,408 @@ def get_erc1155_token_transfers(wallet_address, contract_address=None, start_blo
         url = get_api_url('account', 'token1155tx', address=wallet_address,
                           contract_address=contract_address, start_block=start_block,
                           end_block=end_block, page=page, offset=offset, sort=sort)
-        response = get_json_response(url)
-        if response['status'] == '1' and response['message'] == 'OK':
-            return response['result']
-        elif response['message'] == 'No transactions found':
-            return None
-        else:
-            raise Exception(
-                f"An error occurred while getting erc1155 token transfers: {response}")
+        return parse_transactions(get_json_response(url), 'erc1155 token transfers')
     else:
         return None
 
 
+async def async_get_erc1155_token_transfers(wallet_address, contract_address=None, start_block=0,
+                                            end_block=99999999, page=1, offset=10, sort='desc'):
+    """Awaitable version of get_erc1155_token_transfers.
+
+    Does NOT support Goerli testnet.
+
+    :param str wallet_address: Wallet address
+    :param str contract_address: Specify token contract address, default is all erc1155 tokens
+    :param int start_block: Start block, default is 0
+    :param int end_block: End block, default is 99999999
+    :param int page: Page, default is 1
+    :param int offset: The number of transactions displayed per page, default is 10
+    :param str sort: Sorting preference, asc or desc, default is desc
+    :rtype: list
+    """
+    if not config.get('use_goerli_testnet'):
+        url = get_api_url('account', 'token1155tx', address=wallet_address,
+                          contract_address=contract_address, start_block=start_block,
+                          end_block=end_block, page=page, offset=offset, sort=sort)
+        return parse_transactions(await async_get_json_response(url), 'erc1155 token transfers')
+    else:
+        return None
+
+
+def parse_transactions(response, description):
+    """Parse transaction list from etherscan response.
+
+    :param dict response: Json response of transaction list api
+    :param str description: What is being listed, used in the error message
+    :return list: Transactions, or None if no transactions found
+    """
+    if response['status'] == '1' and response['message'] == 'OK':
+        return response['result']
+    elif response['message'] == 'No transactions found':
+        return None
+    else:
+        raise Exception(
+            f"An error occurred while getting {description}: {response}")
+
+
+async def async_get_transaction_receipt(txn_hash, goerli=False):
+    """Get the receipt of a transaction by the eth_getTransactionReceipt proxy api.
+
+    :param str txn_hash: Transaction hash
+    :param bool goerli: If True, use goerli testnet, default is False
+    :return dict: The receipt, or None if the transaction is not mined yet
+    """
+    url = get_api_url('proxy', 'eth_getTransactionReceipt', goerli=goerli, txhash=txn_hash)
+    return parse_proxy_result(await async_get_json_response(url), 'transaction receipt')
+
+
+async def async_get_transaction_by_hash(txn_hash, goerli=False):
+    """Get a transaction by the eth_getTransactionByHash proxy api.
+
+    :param str txn_hash: Transaction hash
+    :param bool goerli: If True, use goerli testnet, default is False
+    :return dict: The transaction, or None if not found
+    """
+    url = get_api_url('proxy', 'eth_getTransactionByHash', goerli=goerli, txhash=txn_hash)
+    return parse_proxy_result(await async_get_json_response(url), 'transaction')
+
+
+async def async_get_block_timestamp(block_number, goerli=False):
+    """Get the timestamp of a block by the eth_getBlockByNumber proxy api, cached in memory.
+
+    :param int block_number: Block number
+    :param bool goerli: If True, use goerli testnet, default is False
+    :rtype: int
+    """
+    key = (utils.get_network(goerli), block_number)
+    timestamp = block_timestamps.get(key)
+    if timestamp is None:
+        url = get_api_url('proxy', 'eth_getBlockByNumber', goerli=goerli, tag=hex(block_number),
+                          boolean='false')
+        block = parse_proxy_result(await async_get_json_response(url), 'block')
+        if block is None:
+            raise Exception(f'Block {block_number} not found')
+        timestamp = int(block['timestamp'], 16)
+        block_timestamps.set(key, timestamp)
+    return timestamp
+
+
+async def async_get_internal_transactions_by_hash(txn_hash, goerli=False):
+    """Get the internal transactions of a transaction hash.
+
+    :param str txn_hash: Transaction hash
+    :param bool goerli: If True, use goerli testnet, default is False
+    :return list: Internal transactions, or None if no transactions found
+    """
+    url = get_api_url('account', 'txlistinternal', goerli=goerli, txhash=txn_hash)
+    return parse_transactions(await async_get_json_response(url), 'internal transactions')
+
+
+def parse_proxy_result(response, description):
+    """Parse the result of a proxy api response.
+
+    :param dict response: Json-rpc response of proxy api
+    :param str description: What is being got, used in the error message
+    :return: The result, None if not found
+    """
+    if 'error' in response or response.get('status') == '0':
+        raise Exception(f"An error occurred while getting {description}: {response}")
+    return response['result']
+
+
+def decode_transfer_log(log):
+    """Decode a Transfer event log of an erc20 or erc721 contract.
+
+    :param dict log: Log of a transaction receipt
+    :return dict: txn_type, from, to and contract address, with value for erc20 and token id for
+        erc721, or None if the log is not a Transfer event
+    """
+    topics = log.get('topics', [])
+    if len(topics) < 3 or topics[0] != transfer_topic:
+        return None
+    transfer = {'from': '0x' + topics[1][-40:], 'to': '0x' + topics[2][-40:],
+                'contractAddress': log['address'].lower()}
+    if len(topics) == 4:
+        transfer['txn_type'] = 'erc721'
+        transfer['tokenID'] = str(int(topics[3], 16))
+    else:
+        transfer['txn_type'] = 'erc20'
+        transfer['value'] = str(int(log['data'], 16))
+    return transfer
+
+
+async def async_find_transaction(txn_hash, target_address, txn_types, block_number,
+                                 goerli=False):
+    """Find the rows of a transaction by its hash, in the same format as the transaction lists.
+
+    The receipt confirms the transaction, then the rows are built from the receipt, its Transfer
+    logs and the transaction itself, so the cost doesn't depend on how busy the wallet is.
+    The normal row is listed within the block of the transaction, to keep the name of its function.
+    Token names are read from the metadata store, a contract seen for the first time is listed
+    once within the block of the transaction to learn them.
+
+    :param str txn_hash: Transaction hash
+    :param str target_address: Target address
+    :param set txn_types: Types to find, normal, internal, erc20 or erc721
+    :param int block_number: Block number of the transaction
+    :param bool goerli: If True, use goerli testnet, default is False
+    :return dict: Rows of the found types by type, empty if the transaction is not mined yet
+    """
+    receipt = await async_get_transaction_receipt(txn_hash, goerli=goerli)
+    if receipt is None:
+        return {}
+    target_address = target_address.lower()
+    block_number = int(receipt['blockNumber'], 16)
+    normal_row = None
+    if 'normal' in txn_types:
+        normal_row = await async_find_normal_transaction(txn_hash, target_address, block_number,
+                                                         goerli=goerli)
+    txn = None
+    if 'normal' in txn_types and normal_row is None or not receipt.get('effectiveGasPrice'):
+        txn = await async_get_transaction_by_hash(txn_hash, goerli=goerli)
+    gas_price = receipt.get('effectiveGasPrice') or txn['gasPrice']
+    # Token rows carry the gas of their transaction too, like the token transfer lists
+    base = {'hash': txn_hash, 'blockNumber': str(block_number),
+            'timeStamp': str(await async_get_block_timestamp(block_number, goerli=goerli)),
+            'gasPrice': str(int(gas_price, 16)), 'gasUsed': str(int(receipt['gasUsed'], 16))}
+    rows = {}
+    if normal_row is not None:
+        rows['normal'] = normal_row
+    elif 'normal' in txn_types:
+        # Not listed yet, the name of the function is only known if it was listed before
+        method_id = txn['input'][:10] if len(txn['input']) > 2 else '0x'
+        rows['normal'] = {**base, 'from': txn['from'], 'to': txn['to'] or '',
+                          'value': str(int(txn['value'], 16)),
+                          'contractAddress': receipt.get('contractAddress') or '',
+                          'methodId': method_id,
+                          'functionName': function_names.get(method_id) or ''}
+    if 'internal' in txn_types:
+        for row in await async_get_internal_transactions_by_hash(txn_hash, goerli=goerli) or []:
+            if target_address in (row['from'].lower(), row['to'].lower()):
+                rows['internal'] = {**row, 'hash': txn_hash}
+                break
+    network = utils.get_network(goerli)
+    for log in receipt['logs']:
+        transfer = decode_transfer_log(log)
+        if transfer is None or transfer['txn_type'] not in txn_types \
+                or transfer['txn_type'] in rows \
+                or target_address not in (transfer['from'], transfer['to']):
+            continue
+        if metadata_store.get_token_metadata(network, transfer['contractAddress']) is None:
+            row = await async_find_transfer_in_block(txn_hash, target_address, transfer,
+                                                     block_number, goerli=goerli)
+            if row is not None:
+                rows[transfer['txn_type']] = row
+            continue
+        if transfer['txn_type'] == 'erc721':
+            transfer['tokenName'] = metadata_store.get_token_metadata(
+                network, transfer['contractAddress'])['name']
+        rows[transfer['txn_type']] = {**base, **transfer}
+    return rows
+
+
+async def async_find_normal_transaction(txn_hash, target_address, block_number, goerli=False):
+    """Find a normal transaction in the transactions of the wallet within one block, and remember
+    the name of its function by its method id.
+
+    :param str txn_hash: Transaction hash
+    :param str target_address: Target address
+    :param int block_number: Block number of the transaction
+    :param bool goerli: If True, use goerli testnet, default is False
+    :return dict: The transaction row, or None if not indexed yet
+    """
+    rows = await async_get_normal_transactions(target_address, goerli=goerli,
+                                               start_block=block_number, end_block=block_number,
+                                               offset=100)
+    for row in rows or []:
+        if row['hash'] == txn_hash:
+            if row.get('functionName'):
+                function_names.set(row['methodId'], row['functionName'])
+            return row
+    return None
+
+
+async def async_find_transfer_in_block(txn_hash, target_address, transfer, block_number,
+                                       goerli=False):
+    """Find a token transfer in the transfers of its contract within one block, and save the
+    metadata of the contract.
+
+    :param str txn_hash: Transaction hash
+    :param str target_address: Target address
+    :param dict transfer: The decoded Transfer log
+    :param int block_number: Block number of the transaction
+    :param bool goerli: If True, use goerli testnet, default is False
+    :return dict: The transfer row, or None if not indexed yet
+    """
+    if transfer['txn_type'] == 'erc20':
+        rows = await async_get_erc20_token_transfers(
+            target_address, goerli=goerli, contract_address=transfer['contractAddress'],
+            start_block=block_number, end_block=block_number, offset=100)
+    else:
+        rows = await async_get_erc721_token_transfers(
+            target_address, goerli=goerli, contract_address=transfer['contractAddress'],
+            start_block=block_number, end_block=block_number, offset=100)
+    for row in rows or []:
+        if row['hash'] == txn_hash:
+            if transfer['txn_type'] == 'erc20':
+                get_token_metadata(row, goerli=goerli)
+            else:
+                metadata_store.save_token_metadata(utils.get_network(goerli),
+                                                   row['contractAddress'], row['tokenSymbol'],
+                                                   None, row['tokenName'])
+            return row
+    return None
+
+
 def get_json_response(url):
     """Get json response from etherscan
 
-    Using while loop to handle JSONDecodeError, it happens sometimes.
+    Every call has a timeout, failed calls will be retried with exponential backoff and jitter,
+    up to etherscan_max_retries times. Calls fail fast while etherscan is seen as degraded by the
+    circuit breaker.
 
     :param str url: API url to call
     :rtype: dict
     """
-    while True:
+    breaker = get_circuit_breaker(url)
+    error = None
+    for attempt in range(config.get('etherscan_max_retries') + 1):
+        breaker.check()
         try:
-            response = requests.get(url, headers=headers).json()
-            return response
-        except JSONDecodeError:
-            time.sleep(1)
-            continue
+            response = requests.get(url, headers=headers,
+                                    timeout=config.get('etherscan_timeout')).json()
+        except (requests.RequestException, JSONDecodeError) as e:
+            breaker.record_failure()
+            error = e
+        except BaseException:
+            breaker.release()
+            raise
+        else:
+            breaker.record_success()
+            if 'rate limit' not in str(response.get('result')):
+                return response
+            error = response['result']
+        time.sleep(resilience.backoff_delay(attempt))
+    raise Exception(f"Etherscan did not answer after {attempt + 1} attempts: {error}")
+
+
+def get_circuit_breaker(url):
+    """Get the circuit breaker of the etherscan host of the url, create one if not exists.
+
+    :param str url: API url to call
+    :rtype: resilience.CircuitBreaker
+    """
+    host = urlsplit(url).netloc
+    if host not in circuit_breakers:
+        circuit_breakers[host] = resilience.CircuitBreaker(host)
+    return circuit_breakers[host]
+
+
+def get_async_client():
+    """Get the shared async http client of etherscan, create one if not exists.
+
+    All awaitable functions share this client, so connections are pooled and kept alive.
+    The pool size can be configured by etherscan_pool_size in config.yml.
+
+    :rtype: httpx.AsyncClient
+    """
+    global async_client
+    if async_client is None:
+        async_client = utils.create_async_client(config.get('etherscan_pool_size'), headers)
+    return async_client
+
+
+async def close_async_client():
+    """Close the shared async http client of etherscan."""
+    global async_client
+    if async_client is not None:
+        await async_client.aclose()
+        async_client = None
+
+
+async def async_get_json_response(url, priority=scheduler.PRIORITY_VERIFY):
+    """Awaitable version of get_json_response.
+
+    Concurrent calls of the same request share one in-flight request and its result, so the
+    same txlist or balance url asked by several verification tasks only hits etherscan once.
+    Callers joining an in-flight request get a copy of the result, they may format it in place.
+
+    :param str url: API url to call
+    :param int priority: Scheduling priority of the call, default is verification
+    :rtype: dict
+    """
+    global coalesced_requests
+    key = canonical_url(url)
+    task = in_flight_requests.get(key)
+    if task is None:
+        task = asyncio.ensure_future(request_json(url, priority))
+        in_flight_requests[key] = task
+        task.add_done_callback(lambda _: in_flight_requests.pop(key, None))
+        return await asyncio.shield(task)
+    coalesced_requests += 1
+    return copy.deepcopy(await asyncio.shield(task))
+
+
+def canonical_url(url):
+    """Get the canonical form of an api url, the query parameters are sorted.
+
+    :param str url: API url to call
+    :rtype: str
+    """
+    parts = urlsplit(url)
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((parts.scheme, parts.netloc, parts.path, query, ''))
+
+
+async def request_json(url, priority=scheduler.PRIORITY_VERIFY):
+    """Request etherscan under the rate limit, retry and circuit breaker.
+
+    Every call is queued in the shared request scheduler, so all the etherscan traffic of the
+    process stays under etherscan_rate_limit. Verification calls are dispatched before enrichment
+    calls. Retries, timeouts and the circuit breaker work the same as get_json_response.
+
+    :param str url: API url to call
+    :param int priority: Scheduling priority of the call, default is verification
+    :rtype: dict
+    """
+    breaker = get_circuit_breaker(url)
+    error = None
+    for attempt in range(config.get('etherscan_max_retries') + 1):
+        if breaker.is_open():
+            raise resilience.CircuitOpenError(f'Circuit of {breaker.name} is open')
+        try:
+            response = await request_scheduler.submit(lambda: fetch_json(url, breaker), priority)
+        except (httpx.HTTPError, json.JSONDecodeError) as e:
+            error = e
+        else:
+            if 'rate limit' not in str(response.get('result')):
+                return response
+            error = response['result']
+        await asyncio.sleep(resilience.backoff_delay(attempt))
+    raise Exception(f"Etherscan did not answer after {attempt + 1} attempts: {error}")
+
+
+async def fetch_json(url, breaker):
+    """Call etherscan once by the shared async client, record the result to the circuit breaker.
+
+    :param str url: API url to call
+    :param resilience.CircuitBreaker breaker: Circuit breaker of the etherscan host
+    :rtype: dict
+    """
+    breaker.check()
+    try:
+        response = await get_async_client().get(url, timeout=config.get('etherscan_timeout'))
+        result = response.json()
+    except (httpx.HTTPError, json.JSONDecodeError):
+        breaker.record_failure()
+        raise
+    except BaseException:
+        # Cancelled, e.g. the losing side of a hedged lookup, the trial slot must not be kept
+        breaker.release()
+        raise
+    breaker.record_success()
+    return result
 
 
 def format_txn(txn, txn_type, target_address, goerli=False):
@@ -268,12 +853,100 @@ def format_txn(txn, txn_type, target_address, goerli=False):
     :param bool goerli: If True, use goerli testnet, default is False
     :rtype: dict
     """
+    txn['wallet_balance'] = get_wallet_balance(target_address, goerli=goerli)['balance']
+    format_txn_fields(txn, txn_type, goerli=goerli)
+    if txn_type == 'erc20':
+        txn['token_balance'] = get_erc20_token_balance(target_address, txn['contract_address'],
+                                                       txn['token_decimal'], goerli=goerli)
+    if txn_type == 'erc721':
+        txn['nft_image_url'] = alchemy.get_nft_image_url(txn['contract_address'],
+                                                         txn['token_id'], goerli=goerli)
+        txn['nft_image_path'] = None
+        if txn['nft_image_url']:
+            try:
+                txn['nft_image_path'] = image_processing.prepare_image(
+                    image_cache.get_image_path(txn['nft_image_url']))
+            except Exception as e:
+                logging.warning(f'Failed to get the NFT image {txn["nft_image_url"]}: {e}')
+
+    return txn
+
+
+async def async_format_txn(txn, txn_type, target_address, goerli=False):
+    """Awaitable version of format_txn.
+
+    Balances and the NFT image are fetched concurrently. Image cache lookup and download are
+    blocking, so they are run in a thread. The transaction is already verified, so an enrichment
+    that fails is logged and replaced by a placeholder instead of dropping the notification.
+
+    :param dict txn: Transaction
+    :param str txn_type: Transaction type, normal, erc20, erc721 or erc1155
+    :param str target_address: Target address
+    :param bool goerli: If True, use goerli testnet, default is False
+    :rtype: dict
+    """
+    format_txn_fields(txn, txn_type, goerli=goerli)
+    enrichments = [async_get_cached_wallet_balance(target_address, txn['block_number'],
+                                                   goerli=goerli)]
+    if txn_type == 'erc20':
+        enrichments.append(async_get_cached_erc20_token_balance(
+            target_address, txn['contract_address'], txn['token_decimal'], txn['block_number'],
+            goerli=goerli))
+    if txn_type == 'erc721':
+        enrichments.append(async_get_nft_image(txn['contract_address'], txn['token_id'],
+                                               goerli=goerli))
+    placeholders = [{'balance': 'Unknown'}]
+    if txn_type == 'erc20':
+        placeholders.append({'balance': 'Unknown'})
+    if txn_type == 'erc721':
+        placeholders.append((None, None))
+    results = await asyncio.gather(*enrichments, return_exceptions=True)
+    for i, result in enumerate(results):
+        if isinstance(result, Exception):
+            logging.warning(f'Failed to enrich {txn_type} txn {txn["hash"]}: {result}')
+            results[i] = placeholders[i]
+    balance, *results = results
+    txn['wallet_balance'] = balance['balance']
+    if txn_type == 'erc20':
+        txn['token_balance'] = results[0]
+    if txn_type == 'erc721':
+        txn['nft_image_url'], txn['nft_image_path'] = results[0]
+
+    return txn
+
+
+async def async_get_nft_image(contract_address, token_id, goerli=False):
+    """Get the image url of an NFT and the path of its LINE Notify ready image.
+
+    :param str contract_address: NFT contract address
+    :param str token_id: NFT token id
+    :param bool goerli: If True, use goerli testnet, default is False
+    :return tuple: Image url and image path, both None if the NFT has no media. The path is None if
+        the image can't be downloaded or prepared, the notification is then sent without it.
+    """
+    image_url = await alchemy.async_get_nft_image_url(contract_address, token_id, goerli=goerli)
+    if not image_url:
+        return image_url, None
+    try:
+        image_path = await asyncio.to_thread(image_cache.get_image_path, image_url)
+        return image_url, await image_processing.async_prepare_image(image_path)
+    except Exception as e:
+        logging.warning(f'Failed to get the NFT image {image_url}: {e}')
+        return image_url, None
+
+
+def format_txn_fields(txn, txn_type, goerli=False):
+    """Format the fields of transaction which can be parsed without calling any api.
+
+    :param dict txn: Transaction
+    :param str txn_type: Transaction type, normal, erc20, erc721 or erc1155
+    :param bool goerli: If True, use goerli testnet, default is False
+    :rtype: dict
+    """
     if not goerli:
         base_url = 'https://etherscan.io'
-        txn['wallet_balance'] = get_wallet_balance(target_address)['balance']
     else:
         base_url = 'https://goerli.etherscan.io'
-        txn['wallet_balance'] = get_wallet_balance(target_address, goerli=True)['balance']
     if 'gasPrice' in txn:
         txn['gas_price'] = utils.wei_to_gwei(int(txn['gasPrice']))
         txn['gas_used'] = float(txn['gasUsed'])
@@ -287,31 +960,17 @@ def format_txn(txn, txn_type, target_address, goerli=False):
         if txn['methodId'] == '0x':
             txn['action'] = 'Transfer'
         else:
-            txn['action'] = txn['functionName'].split('(')[0]
+            # A row built from the transaction before it's listed may only know the method id
+            txn['action'] = txn['functionName'].split('(')[0] or txn['methodId']
     if txn_type == 'internal':
         txn['eth_value'] = utils.wei_to_eth(int(txn['value']))
     if txn_type == 'erc20':
-        txn['token_symbol'] = txn['tokenSymbol']
-        txn['token_decimal'] = int(txn['tokenDecimal'])
+        metadata = get_token_metadata(txn, goerli=goerli)
+        txn['token_symbol'] = metadata['symbol']
+        txn['token_decimal'] = metadata['decimals']
         txn['value'] = round(int(txn['value']) / 10 ** txn['token_decimal'], 4)
-        if not goerli:
-            txn['token_balance'] = get_erc20_token_balance(target_address, txn['contract_address'],
-                                                           txn['token_decimal'])
-        else:
-            txn['token_balance'] = get_erc20_token_balance(target_address, txn['contract_address'],
-                                                           txn['token_decimal'], goerli=True)
     if txn_type == 'erc721':
         txn['token_name'] = txn['tokenName']
         txn['token_id'] = txn['tokenID']
-        if not goerli:
-            txn['nft_image_url'] = \
-                alchemy.get_nft_metadata(txn['contract_address'], txn['token_id'])['nft_image_url']
-        else:
-            txn['nft_image_url'] = \
-                alchemy.get_nft_metadata(txn['contract_address'], txn['token_id'],
-                                         goerli=True)['nft_image_url']
-        txn['nft_image_path'] = utils.download_png_from_url(
-            f"{txn['token_name']}_{txn['contract_address']}",
-            txn['nft_image_url'], txn['token_id'])
 
     return txn
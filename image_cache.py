@@ -0,0 +1,118 @@
+"""This python file will download NFT images into a content-addressed cache on disk.
+
+Images are saved by the sha256 digest of their content, so the same image is saved once no matter
+how many urls or collections it comes from. The cache is bounded by image_cache_size_mb in
+config.yml, the least recently used images will be evicted first.
+"""
+import glob
+import hashlib
+import logging
+import os
+import tempfile
+
+import requests
+
+import image_processing
+import metadata_store
+import utilities as utils
+
+config = utils.read_config()
+cache_dir = './images/nft_images'
+extensions = {'image/png': 'png', 'image/jpeg': 'jpg', 'image/gif': 'gif', 'image/webp': 'webp',
+              'image/svg+xml': 'svg'}
+
+
+def get_image_path(url):
+    """Get the local path of the image of url, download it if not cached.
+
+    The image is streamed in chunks, and the download is aborted once it grows over
+    image_max_size_mb in config.yml.
+
+    :param str url: Url of the image.
+    :return str: Path of the image file.
+    """
+    image = metadata_store.get_image_by_url(url)
+    if image is not None and os.path.exists(image['path']):
+        return image['path']
+    if image is not None:
+        metadata_store.remove_image(image['digest'])
+    return download_image(url)
+
+
+def download_image(url):
+    """Download the image of url into the cache, then evict images if the cache is full.
+
+    :param str url: Url of the image.
+    :return str: Path of the image file.
+    """
+    max_size = config.get('image_max_size_mb') * 1024 * 1024
+    os.makedirs(cache_dir, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    fd, temp_path = tempfile.mkstemp(dir=cache_dir, suffix='.part')
+    try:
+        with requests.get(url, allow_redirects=True, timeout=5, stream=True) as r, \
+                os.fdopen(fd, 'wb') as file:
+            r.raise_for_status()
+            content_type = r.headers.get('Content-Type', '').split(';')[0].strip()
+            for chunk in r.iter_content(chunk_size=64 * 1024):
+                size += len(chunk)
+                if size > max_size:
+                    raise Exception(f'Image is larger than {max_size} bytes: {url}')
+                digest.update(chunk)
+                file.write(chunk)
+        digest = digest.hexdigest()
+        image = metadata_store.get_image_by_digest(digest)
+        if image is not None and os.path.exists(image['path']):
+            os.remove(temp_path)
+            path = image['path']
+        else:
+            path = f'{cache_dir}/{digest[:2]}/{digest}.{extensions.get(content_type, "png")}'
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    metadata_store.save_image(url, digest, path, size)
+    evict_images()
+    return path
+
+
+def evict_images():
+    """Evict the least recently used images until the cache fits in image_cache_size_mb.
+
+    The processed variants of the images are counted in the size of the cache too.
+    """
+    quota = config.get('image_cache_size_mb') * 1024 * 1024
+    total_size = metadata_store.get_images_total_size() + get_variants_size()
+    while total_size > quota:
+        image = metadata_store.pop_least_recently_used_image()
+        if image is None:
+            break
+        # Processed variants are saved next to the original with the same digest prefix
+        for path in glob.glob(f'{os.path.splitext(image["path"])[0]}.*'):
+            total_size -= get_file_size(path)
+            os.remove(path)
+        logging.debug(f'Evicted cached image - {image["path"]}')
+
+
+def get_variants_size():
+    """Get the total size of the processed variants of all cached images in bytes.
+
+    :rtype: int
+    """
+    pattern = image_processing.get_processed_path(f'{cache_dir}/*/*')
+    return sum(get_file_size(path) for path in glob.glob(pattern))
+
+
+def get_file_size(path):
+    """Get the size of a file in bytes, 0 if it was removed meanwhile.
+
+    :param str path: Path of the file.
+    :rtype: int
+    """
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return 0
@@ -0,0 +1,108 @@
+"""This python file will shrink NFT images to fit LINE Notify before they are uploaded.
+
+LINE Notify only accepts PNG and JPEG, and every image is uploaded once per subscriber, so images
+are transcoded to JPEG and resized to line_image_max_px once, then saved next to the original.
+Resizing is CPU heavy, so it's run in a process pool to keep the event loop free.
+"""
+import asyncio
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import utilities as utils
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+config = utils.read_config()
+executor = None
+
+
+def get_processed_path(path):
+    """Get the path of the processed variant of an image.
+
+    :param str path: Path of the original image.
+    :rtype: str
+    """
+    return f'{os.path.splitext(path)[0]}.line.jpg'
+
+
+def process_image(path, max_px):
+    """Transcode an image to JPEG and resize it to fit in max_px, skip if already processed.
+
+    Animated images keep their first frame only, transparent background is filled with white.
+
+    :param str path: Path of the original image.
+    :param int max_px: Max width and height of the processed image.
+    :return str: Path of the processed image.
+    """
+    processed_path = get_processed_path(path)
+    if os.path.exists(processed_path):
+        return processed_path
+    with Image.open(path) as image:
+        image.seek(0)
+        image = image.convert('RGBA')
+        image.thumbnail((max_px, max_px))
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+    temp_path = f'{processed_path}.{os.getpid()}.part'
+    background.save(temp_path, 'JPEG', quality=85, optimize=True)
+    os.replace(temp_path, processed_path)
+    return processed_path
+
+
+def prepare_image(path):
+    """Get the LINE Notify ready variant of an image, process it if not processed yet.
+
+    The original image is returned if Pillow is not installed or the image can't be processed.
+
+    :param str path: Path of the original image.
+    :rtype: str
+    """
+    if Image is None:
+        return path
+    try:
+        return process_image(path, config.get('line_image_max_px'))
+    except Exception as e:
+        logging.warning(f'Failed to process image {path}, sending the original one: {e}')
+        return path
+
+
+async def async_prepare_image(path):
+    """Awaitable version of prepare_image, the image is processed in the process pool.
+
+    :param str path: Path of the original image.
+    :rtype: str
+    """
+    processed_path = get_processed_path(path)
+    if os.path.exists(processed_path):
+        return processed_path
+    if Image is None:
+        return path
+    try:
+        return await asyncio.get_running_loop().run_in_executor(
+            get_executor(), process_image, path, config.get('line_image_max_px'))
+    except Exception as e:
+        logging.warning(f'Failed to process image {path}, sending the original one: {e}')
+        return path
+
+
+def get_executor():
+    """Get the process pool for image processing, create one if not exists.
+
+    :rtype: ProcessPoolExecutor
+    """
+    global executor
+    if executor is None:
+        executor = ProcessPoolExecutor(max_workers=config.get('image_process_workers'))
+    return executor
+
+
+def shutdown():
+    """Shutdown the process pool for image processing."""
+    global executor
+    if executor is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
+        executor = None
@@ -0,0 +1,134 @@
+"""This python file will queue the Alchemy webhooks to be processed in the background.
+
+The webhook endpoint only validates and queues a payload, then returns right away, so Alchemy never
+waits on the processing and never retries because of a slow response. The queue is bounded, when
+it's full the payloads are spilled into a file on disk, and fed back into the queue once it drains.
+Alchemy may deliver the same webhook more than once, event ids are remembered for a while so the
+retried deliveries are dropped before queueing.
+"""
+import asyncio
+import json
+import logging
+import os
+
+import cache
+
+
+class IngestQueue:
+    """Bounded queue of webhook payloads which spills to disk when full."""
+
+    def __init__(self, maxsize=1000, spill_path='./ingest_spill.jsonl', idempotency_ttl=3600):
+        """Create the queue.
+
+        :param int maxsize: Max number of payloads kept in memory.
+        :param str spill_path: Path of the file the overflowed payloads are spilled into.
+        :param float idempotency_ttl: Seconds to remember the event id of a received webhook.
+        """
+        self.maxsize = maxsize
+        self.spill_path = spill_path
+        self.reading_path = f'{spill_path}.reading'
+        self.queue = None
+        self.received = 0
+        self.spilled = 0
+        self.restored = 0
+        self.duplicates = 0
+        self.event_ids = cache.LRUCache(maxsize=100000, ttl=idempotency_ttl)
+
+    def is_duplicate(self, event_id):
+        """Check if a webhook event was received before, remember it if not.
+
+        :param str event_id: Event id of the webhook, None is never a duplicate.
+        :rtype: bool
+        """
+        if event_id is None:
+            return False
+        if event_id in self.event_ids:
+            self.duplicates += 1
+            return True
+        self.event_ids.set(event_id, True)
+        return False
+
+    def get_queue(self):
+        """Get the queue, create it in the running event loop if not created yet.
+
+        :rtype: asyncio.Queue
+        """
+        if self.queue is None:
+            self.queue = asyncio.Queue(self.maxsize)
+        return self.queue
+
+    def submit(self, payload):
+        """Queue a payload, spill it to disk if the queue is full.
+
+        :param dict payload: The webhook payload.
+        :return bool: True if queued in memory, False if spilled to disk.
+        """
+        self.received += 1
+        try:
+            self.get_queue().put_nowait(payload)
+            return True
+        except asyncio.QueueFull:
+            self.spill([payload])
+            return False
+
+    def spill(self, payloads):
+        """Append payloads to the spill file.
+
+        :param list payloads: The webhook payloads.
+        """
+        with open(self.spill_path, 'a', encoding="utf8") as file:
+            for payload in payloads:
+                file.write(json.dumps(payload) + '\n')
+        self.spilled += len(payloads)
+
+    def spill_queued(self):
+        """Spill every payload still in the queue, used at shutdown so they are not lost."""
+        payloads = []
+        while self.queue is not None and not self.queue.empty():
+            payloads.append(self.queue.get_nowait())
+        if payloads:
+            self.spill(payloads)
+            logging.info(f'Spilled {len(payloads)} queued webhooks to {self.spill_path}.')
+
+    async def get(self):
+        """Wait for the next payload.
+
+        :rtype: dict
+        """
+        return await self.get_queue().get()
+
+    async def run_spill_reader(self, interval=1.0):
+        """Feed the spilled payloads back into the queue once it's half empty, run forever.
+
+        The spill file is moved aside before reading, so new payloads can be spilled meanwhile.
+
+        :param float interval: Seconds between two checks of the spill file.
+        """
+        queue = self.get_queue()
+        while True:
+            await asyncio.sleep(interval)
+            if queue.qsize() > self.maxsize // 2:
+                continue
+            if not os.path.exists(self.reading_path):
+                if not os.path.exists(self.spill_path):
+                    continue
+                os.replace(self.spill_path, self.reading_path)
+            with open(self.reading_path, encoding="utf8") as file:
+                for line in file:
+                    try:
+                        payload = json.loads(line)
+                    except json.JSONDecodeError:
+                        logging.warning(f'Skipped a broken line in {self.reading_path}.')
+                        continue
+                    await queue.put(payload)
+                    self.restored += 1
+            os.remove(self.reading_path)
+
+    def stats(self):
+        """Get the statistics of the queue.
+
+        :rtype: dict
+        """
+        return {'depth': self.queue.qsize() if self.queue is not None else 0,
+                'received': self.received, 'duplicates': self.duplicates,
+                'spilled': self.spilled, 'restored': self.restored}
@@ -0,0 +1,96 @@
+"""This python file will keep an append-only journal of the wallet registry mutations.
+
+Every mutation is appended as one json line, and the journal is fsynced in batches, so the cost of
+a change is one short line no matter how many wallets are tracked. The journal is compacted into
+the wallet database in the background, and replayed into it at start if the bot was stopped
+before compaction.
+"""
+import json
+import logging
+import os
+
+
+class MutationJournal:
+    """Append-only journal of registry mutations, one json line per mutation.
+
+    Compaction rotates the journal to a .compacting file first, so new mutations can be appended
+    while the rotated ones are being written to the database.
+    """
+
+    def __init__(self, path):
+        """
+        :param str path: Path of the journal file.
+        """
+        self.path = path
+        self.compacting_path = f'{path}.compacting'
+        self.file = None
+        self.unsynced = 0
+
+    def append(self, mutation):
+        """Append a mutation to the journal, it's durable after the next sync.
+
+        :param tuple mutation: Operation name and its arguments.
+        """
+        if self.file is None:
+            self.file = open(self.path, 'a', encoding="utf8")
+        self.file.write(json.dumps(mutation) + '\n')
+        self.unsynced += 1
+
+    def sync(self):
+        """Flush and fsync all appended mutations to disk.
+
+        :return int: Number of mutations synced.
+        """
+        if self.file is None or not self.unsynced:
+            return 0
+        synced, self.unsynced = self.unsynced, 0
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return synced
+
+    def rotate(self):
+        """Sync and close the journal, then move it aside for compaction.
+
+        :return bool: False if there is nothing to compact.
+        """
+        self.sync()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if not os.path.exists(self.path):
+            return False
+        if not os.path.exists(self.compacting_path):
+            os.replace(self.path, self.compacting_path)
+            return True
+        # The last compaction failed, keep its mutations in front of the new ones
+        with open(self.path, encoding="utf8") as source, \
+                open(self.compacting_path, 'a', encoding="utf8") as target:
+            target.write(source.read())
+            target.flush()
+            os.fsync(target.fileno())
+        os.remove(self.path)
+        return True
+
+    def discard_rotated(self):
+        """Remove the rotated journal after it's compacted into the database."""
+        if os.path.exists(self.compacting_path):
+            os.remove(self.compacting_path)
+
+    def replay(self):
+        """Read the mutations left in the rotated and current journal files, oldest first.
+
+        A partly written last line from a crash is skipped.
+
+        :return list: Mutations in the order they happened.
+        """
+        mutations = []
+        for path in (self.compacting_path, self.path):
+            if not os.path.exists(path):
+                continue
+            with open(path, encoding="utf8") as file:
+                for line in file:
+                    try:
+                        mutations.append(tuple(json.loads(line)))
+                    except json.JSONDecodeError:
+                        logging.warning(f'Skipped a broken line in the journal {path}.')
+        return mutations
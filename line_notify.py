@@ -23,17 +23,19 @@ def send_message(message, token):
                   headers=headers, data=data, timeout=5)
 
 
-def send_image_message(message, image_path, token):
+def send_image_message(message, image_path, token, image=None):
     """Send media message to LINE Notify.
 
     :param str message: Message to send.
     :param str image_path: Path to media.
     :param str token: LINE Notify token.
+    :param bytes image: Content of the media if it's already read, default is reading image_path.
     """
     headers = {"Authorization": "Bearer " + token}
     data = {'message': message}
-    with open(image_path, 'rb') as f:
-        image = f.read()
+    if image is None:
+        with open(image_path, 'rb') as f:
+            image = f.read()
     files = {'imageFile': image}
     requests.post("https://notify-api.line.me/api/notify",
                   headers=headers, data=data, files=files, timeout=5)
@@ -193,8 +195,20 @@ def send_notify(txn, txn_type, line_notify_tokens):
                   f"Current Balance: {txn['wallet_balance']} ETH\n" \
                   f"Token Balance: {txn['token_balance']['balance']} {txn['token_symbol']}\n" \
                   f"{txn['txn_url']}"
+    elif txn_type == 'fast':
+        message = f"New Transaction Detected!\n" \
+                  f"------------------------------------\n" \
+                  f"Wallet: {txn['target']}\n" \
+                  f"Block: {txn['block_num']}\n" \
+                  f"{txn['transfers']}\n" \
+                  f"------------------------------------\n" \
+                  f"{txn['txn_url']}"
+    image = None
+    if '721' in txn_type and txn.get('nft_image_path'):
+        with open(txn['nft_image_path'], 'rb') as f:
+            image = f.read()
     for token in line_notify_tokens:
-        if '721' in txn_type:
-            send_image_message(message, txn['nft_image_path'], token)
+        if image is not None:
+            send_image_message(message, txn['nft_image_path'], token, image=image)
         else:
             send_message(message, token)
@@ -0,0 +1,219 @@
+"""This python file will save the metadata of token contracts, NFTs and NFT images on disk.
+
+Metadata of a contract or an NFT barely changes, so it's saved in a SQLite file and kept in memory
+once read, every contract or NFT only needs to be parsed or fetched once.
+"""
+import sqlite3
+import threading
+import time
+
+import cache
+
+db_path = './metadata.db'
+connection = None
+lock = threading.Lock()
+token_metadata = {}
+nft_metadata = cache.LRUCache(maxsize=10000)
+
+
+def get_connection():
+    """Get the connection of the metadata database, create the tables if not exists.
+
+    :rtype: sqlite3.Connection
+    """
+    global connection
+    if connection is None:
+        connection = sqlite3.connect(db_path, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute("""CREATE TABLE IF NOT EXISTS token_metadata (
+            network TEXT NOT NULL,
+            contract_address TEXT NOT NULL,
+            symbol TEXT,
+            decimals INTEGER,
+            name TEXT,
+            PRIMARY KEY (network, contract_address))""")
+        connection.execute("""CREATE TABLE IF NOT EXISTS nft_metadata (
+            network TEXT NOT NULL,
+            contract_address TEXT NOT NULL,
+            token_id TEXT NOT NULL,
+            image_url TEXT,
+            fetched_at REAL NOT NULL,
+            PRIMARY KEY (network, contract_address, token_id))""")
+        connection.execute("""CREATE TABLE IF NOT EXISTS images (
+            digest TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            last_access REAL NOT NULL)""")
+        connection.execute("""CREATE TABLE IF NOT EXISTS image_urls (
+            url TEXT PRIMARY KEY,
+            digest TEXT NOT NULL REFERENCES images (digest))""")
+        connection.execute('CREATE INDEX IF NOT EXISTS images_last_access ON images (last_access)')
+        connection.execute('CREATE INDEX IF NOT EXISTS image_urls_digest ON image_urls (digest)')
+        connection.commit()
+    return connection
+
+
+def get_token_metadata(network, contract_address):
+    """Get the metadata of an ERC20 token contract.
+
+    :param str network: The network of the contract. (ETH_MAINNET or ETH_GOERLI)
+    :param str contract_address: The address of the token contract.
+    :return dict: Symbol, decimals and name of the token, or None if not saved yet.
+    """
+    key = (network, contract_address.lower())
+    if key not in token_metadata:
+        with lock:
+            row = get_connection().execute(
+                'SELECT symbol, decimals, name FROM token_metadata '
+                'WHERE network = ? AND contract_address = ?', key).fetchone()
+        if row is None:
+            return None
+        token_metadata[key] = {'symbol': row[0], 'decimals': row[1], 'name': row[2]}
+    return token_metadata[key]
+
+
+def save_token_metadata(network, contract_address, symbol, decimals, name):
+    """Save the metadata of an ERC20 token contract.
+
+    :param str network: The network of the contract. (ETH_MAINNET or ETH_GOERLI)
+    :param str contract_address: The address of the token contract.
+    :param str symbol: Symbol of the token.
+    :param int decimals: Decimals of the token.
+    :param str name: Name of the token.
+    :return dict: The saved metadata.
+    """
+    key = (network, contract_address.lower())
+    with lock:
+        get_connection().execute(
+            'INSERT OR REPLACE INTO token_metadata VALUES (?, ?, ?, ?, ?)',
+            (*key, symbol, decimals, name))
+        get_connection().commit()
+    token_metadata[key] = {'symbol': symbol, 'decimals': decimals, 'name': name}
+    return token_metadata[key]
+
+
+def get_nft_metadata(network, contract_address, token_id):
+    """Get the saved metadata of an NFT.
+
+    :param str network: The network of the NFT. (ETH_MAINNET or ETH_GOERLI)
+    :param str contract_address: The address of the NFT contract.
+    :param str token_id: The id of the NFT.
+    :return dict: Image url and fetched time of the NFT, or None if not saved yet.
+        Image url is None if the NFT has no media.
+    """
+    key = (network, contract_address.lower(), str(token_id))
+    metadata = nft_metadata.get(key)
+    if metadata is None:
+        with lock:
+            row = get_connection().execute(
+                'SELECT image_url, fetched_at FROM nft_metadata '
+                'WHERE network = ? AND contract_address = ? AND token_id = ?', key).fetchone()
+        if row is None:
+            return None
+        metadata = {'image_url': row[0], 'fetched_at': row[1]}
+        nft_metadata.set(key, metadata)
+    return metadata
+
+
+def save_nft_metadata(network, contract_address, token_id, image_url):
+    """Save the metadata of an NFT.
+
+    :param str network: The network of the NFT. (ETH_MAINNET or ETH_GOERLI)
+    :param str contract_address: The address of the NFT contract.
+    :param str token_id: The id of the NFT.
+    :param str image_url: Image url of the NFT, None if the NFT has no media.
+    :return dict: The saved metadata.
+    """
+    key = (network, contract_address.lower(), str(token_id))
+    metadata = {'image_url': image_url, 'fetched_at': time.time()}
+    with lock:
+        get_connection().execute('INSERT OR REPLACE INTO nft_metadata VALUES (?, ?, ?, ?, ?)',
+                                 (*key, image_url, metadata['fetched_at']))
+        get_connection().commit()
+    nft_metadata.set(key, metadata)
+    return metadata
+
+
+def get_image_by_url(url):
+    """Get the cached image downloaded from url, and mark it as recently used.
+
+    :param str url: Url the image was downloaded from.
+    :return dict: Digest, path and size of the image, or None if not cached.
+    """
+    with lock:
+        row = get_connection().execute(
+            'SELECT images.digest, path, size FROM image_urls '
+            'JOIN images ON images.digest = image_urls.digest WHERE url = ?', (url,)).fetchone()
+        if row is None:
+            return None
+        get_connection().execute('UPDATE images SET last_access = ? WHERE digest = ?',
+                                 (time.time(), row[0]))
+        get_connection().commit()
+    return {'digest': row[0], 'path': row[1], 'size': row[2]}
+
+
+def get_image_by_digest(digest):
+    """Get the cached image by the digest of its content.
+
+    :param str digest: Sha256 hex digest of the image.
+    :return dict: Digest, path and size of the image, or None if not cached.
+    """
+    with lock:
+        row = get_connection().execute('SELECT digest, path, size FROM images WHERE digest = ?',
+                                       (digest,)).fetchone()
+    if row is None:
+        return None
+    return {'digest': row[0], 'path': row[1], 'size': row[2]}
+
+
+def save_image(url, digest, path, size):
+    """Save a downloaded image, images with the same digest are shared by all of their urls.
+
+    :param str url: Url the image was downloaded from.
+    :param str digest: Sha256 hex digest of the image.
+    :param str path: Path of the image file.
+    :param int size: Size of the image file in bytes.
+    """
+    with lock:
+        get_connection().execute(
+            'INSERT INTO images VALUES (?, ?, ?, ?) '
+            'ON CONFLICT (digest) DO UPDATE SET last_access = excluded.last_access',
+            (digest, path, size, time.time()))
+        get_connection().execute('INSERT OR REPLACE INTO image_urls VALUES (?, ?)', (url, digest))
+        get_connection().commit()
+
+
+def get_images_total_size():
+    """Get the total size of all cached images in bytes.
+
+    :rtype: int
+    """
+    with lock:
+        return get_connection().execute('SELECT COALESCE(SUM(size), 0) FROM images').fetchone()[0]
+
+
+def pop_least_recently_used_image():
+    """Remove the least recently used image and its urls from the store.
+
+    :return dict: Digest, path and size of the removed image, or None if there is no image.
+    """
+    with lock:
+        row = get_connection().execute(
+            'SELECT digest, path, size FROM images ORDER BY last_access LIMIT 1').fetchone()
+        if row is None:
+            return None
+        get_connection().execute('DELETE FROM image_urls WHERE digest = ?', (row[0],))
+        get_connection().execute('DELETE FROM images WHERE digest = ?', (row[0],))
+        get_connection().commit()
+    return {'digest': row[0], 'path': row[1], 'size': row[2]}
+
+
+def remove_image(digest):
+    """Remove an image and its urls from the store.
+
+    :param str digest: Sha256 hex digest of the image.
+    """
+    with lock:
+        get_connection().execute('DELETE FROM image_urls WHERE digest = ?', (digest,))
+        get_connection().execute('DELETE FROM images WHERE digest = ?', (digest,))
+        get_connection().commit()
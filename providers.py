@@ -0,0 +1,154 @@
+"""This python file will send the verification lookups to Etherscan or Alchemy, hedged by the other.
+
+Both providers find a transaction by hash and answer rows in the same format. A lookup goes to the
+primary provider of the network first, if it hasn't answered after a percentile of its recent
+latencies, or it fails, the same lookup is sent to the other provider. The first provider finding
+the transaction wins and the other request is cancelled. A provider answering that the transaction
+isn't found yet is trusted, it's not hedged.
+"""
+import asyncio
+import time
+from collections import deque
+
+import alchemy
+import etherscan as eth
+
+# Functions to find a transaction by hash, by the name of the provider
+find_functions = {'etherscan': eth.async_find_transaction,
+                  'alchemy': alchemy.async_find_transaction}
+
+
+class ProviderStats:
+    """Recent latencies and counters of one provider."""
+
+    def __init__(self, window=200):
+        self.latencies = deque(maxlen=window)
+        self.calls = 0
+        self.errors = 0
+        self.hedges = 0
+        self.wins = 0
+
+    def get_percentile(self, percentile):
+        """Get a percentile of the recent latencies.
+
+        :param float percentile: The percentile, from 0 to 100.
+        :return float: Seconds, None if no latency is recorded yet.
+        """
+        if not self.latencies:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[round(percentile / 100 * (len(latencies) - 1))]
+
+
+class HedgedProviders:
+    """Find transactions on a primary provider, hedged by the other providers."""
+
+    def __init__(self, percentile=95, min_delay=0.2, max_delay=5, min_samples=10):
+        """Create the providers.
+
+        :param float percentile: Percentile of the latencies of the primary provider to wait
+            before hedging, 0 disables hedging.
+        :param float min_delay: Min seconds to wait before hedging.
+        :param float max_delay: Max seconds to wait before hedging, also used until enough
+            latencies are recorded.
+        :param int min_samples: Latencies to record before the percentile is used.
+        """
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.min_samples = min_samples
+        self.stats = {name: ProviderStats() for name in find_functions}
+
+    def get_hedge_delay(self, name):
+        """Get the seconds to wait for a provider before hedging.
+
+        :param str name: The name of the provider.
+        :rtype: float
+        """
+        stats = self.stats[name]
+        if len(stats.latencies) < self.min_samples:
+            return self.max_delay
+        return min(max(stats.get_percentile(self.percentile), self.min_delay), self.max_delay)
+
+    async def call(self, name, *args, **kwargs):
+        """Find a transaction on one provider, record its latency, also when it's cancelled.
+
+        :param str name: The name of the provider.
+        :return dict: Rows of the found types by type.
+        """
+        stats = self.stats[name]
+        stats.calls += 1
+        started_at = time.monotonic()
+        try:
+            rows = await find_functions[name](*args, **kwargs)
+        except asyncio.CancelledError:
+            # It lost the race, so its latency is at least the time it took so far. Dropping it
+            # would keep only the fast samples and shrink the hedge delay.
+            stats.latencies.append(time.monotonic() - started_at)
+            raise
+        except Exception:
+            stats.errors += 1
+            raise
+        stats.latencies.append(time.monotonic() - started_at)
+        return rows
+
+    async def find_transaction(self, primary, txn_hash, target_address, txn_types, block_number,
+                               goerli=False):
+        """Find the rows of a transaction, hedged by the other providers.
+
+        :param str primary: The name of the provider to ask first.
+        :param str txn_hash: The hash of the transaction.
+        :param str target_address: The target wallet address.
+        :param set txn_types: Types to find, normal, internal, erc20 or erc721.
+        :param int block_number: The block number of the transaction.
+        :param bool goerli: Whether to use goerli test network.
+        :return dict: Rows of the found types by type, empty if no provider found it.
+        :raises Exception: The last error if every provider failed.
+        """
+        args = (txn_hash, target_address, txn_types, block_number)
+        alternates = [name for name in find_functions if name != primary] if self.percentile else []
+        tasks = {asyncio.ensure_future(self.call(primary, *args, goerli=goerli)): primary}
+        pending = set(tasks)
+        answered = False
+        error = None
+        try:
+            while pending:
+                timeout = self.get_hedge_delay(tasks[next(iter(pending))]) if alternates else None
+                done, pending = await asyncio.wait(pending, timeout=timeout,
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                failed = False
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                        failed = True
+                        continue
+                    answered = True
+                    if task.result():
+                        self.stats[tasks[task]].wins += 1
+                        return task.result()
+                # Too slow or failed, ask the next provider. Not found is a valid answer while the
+                # transaction is being indexed, the next poll asks again.
+                if alternates and (not done or failed and not pending):
+                    name = alternates.pop(0)
+                    self.stats[name].hedges += 1
+                    task = asyncio.ensure_future(self.call(name, *args, goerli=goerli))
+                    tasks[task] = name
+                    pending.add(task)
+        finally:
+            for task in pending:
+                task.cancel()
+        if not answered and error is not None:
+            raise error
+        return {}
+
+    def get_stats(self):
+        """Get the statistics of the providers.
+
+        :rtype: dict
+        """
+        return {name: {'calls': stats.calls, 'errors': stats.errors, 'hedges': stats.hedges,
+                       'wins': stats.wins,
+                       'p50_seconds': round(stats.get_percentile(50) or 0, 3),
+                       'p95_seconds': round(stats.get_percentile(95) or 0, 3),
+                       'hedge_delay': round(self.get_hedge_delay(name), 3)}
+                for name, stats in self.stats.items()}
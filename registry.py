@@ -0,0 +1,291 @@
+"""This python file will keep the wallet registry in memory.
+
+Every lookup of the webhooks and the bot commands is served from hash indexes in memory, and every
+change is applied to the indexes in O(1) right away. Changes are appended to a journal that is
+fsynced in batches, and compacted into the wallet database in the background, so disk writes are
+proportional to the change and never block webhook routing.
+"""
+import asyncio
+import atexit
+import logging
+import threading
+import time
+
+import journal
+import wallet_store
+
+journal_path = './wallets.journal'
+
+
+def encode_address(address):
+    """Normalise a hex wallet address into a 20-byte key.
+
+    :param str address: Wallet address in hex with 0x prefix, in any case.
+    :rtype: bytes
+    :raises ValueError: If the address is not a 20-byte hex address.
+    """
+    if len(address) != 42 or address[:2] not in ('0x', '0X'):
+        raise ValueError(f'Invalid wallet address: {address}')
+    return bytes.fromhex(address[2:])
+
+
+def decode_address(key):
+    """Get the lowercase hex wallet address of a 20-byte key.
+
+    :param bytes key: 20-byte key of the address.
+    :rtype: str
+    """
+    return '0x' + key.hex()
+
+
+class WalletRegistry:
+    """In-memory wallet registry with hash indexes.
+
+    Indexes:
+    - address_tokens: network -> address key -> tuple of notify token handles tracking the address
+    - user_addresses: (user_id, network) -> address keys tracked by the user
+    - user_tokens: user_id -> notify token handle of the user
+
+    Addresses are kept as 20-byte keys normalised once at insert, and notify tokens are interned
+    as integer handles, so a token shared by many wallets is stored only once.
+    Sets of addresses are dicts with None values, they keep the order of insertion.
+    """
+
+    def __init__(self, mutation_journal=None):
+        """
+        :param journal.MutationJournal mutation_journal: Journal of the mutations, the mutations
+            are only written to the wallet database at compaction if not given.
+        """
+        self.webhook_ids = {}
+        self.address_tokens = {}
+        self.user_addresses = {}
+        self.user_tokens = {}
+        self.tokens = []
+        self.token_handles = {}
+        self.pending = []
+        self.journal = mutation_journal
+        self.last_compaction = time.monotonic()
+        self.lock = threading.Lock()
+        self.compaction_lock = threading.Lock()
+
+    def intern_token(self, notify_token):
+        """Get the handle of a notify token, assign a new one if not interned yet.
+
+        :param str notify_token: LINE Notify token.
+        :rtype: int
+        """
+        handle = self.token_handles.get(notify_token)
+        if handle is None:
+            handle = self.token_handles[notify_token] = len(self.tokens)
+            self.tokens.append(notify_token)
+        return handle
+
+    def load(self, rows):
+        """Build the indexes from the rows of the wallet database.
+
+        Addresses that are not valid 20-byte hex addresses are skipped.
+
+        :param dict rows: Rows returned by wallet_store.load_all.
+        """
+        for network, webhook_id in rows['webhooks']:
+            self.webhook_ids[network] = webhook_id
+        for network, address, notify_token in rows['tracking_wallets']:
+            try:
+                self.index_tracking_wallet(network, encode_address(address), notify_token)
+            except ValueError:
+                logging.warning(f'Skipped invalid tracking address {address} of {network}.')
+        for user_id, network, address in rows['user_tracking']:
+            try:
+                key = encode_address(address)
+            except ValueError:
+                logging.warning(f'Skipped invalid tracking address {address} of user {user_id}.')
+                continue
+            self.user_addresses.setdefault((user_id, network), {})[key] = None
+        for user_id, notify_token in rows['notify_tokens']:
+            self.user_tokens[user_id] = self.intern_token(notify_token)
+
+    def index_tracking_wallet(self, network, key, notify_token):
+        """Add a notify token to the tokens of an address key in the index."""
+        wallets = self.address_tokens.setdefault(network, {})
+        handle = self.intern_token(notify_token)
+        handles = wallets.get(key, ())
+        if handle not in handles:
+            wallets[key] = handles + (handle,)
+
+    def record(self, *mutation):
+        """Append a mutation to the journal and queue it for compaction."""
+        with self.lock:
+            self.pending.append(mutation)
+            if self.journal is not None:
+                self.journal.append(mutation)
+
+    def get_webhook_id(self, network):
+        """Get the alchemy webhook id of a network."""
+        return self.webhook_ids.get(network)
+
+    def set_webhook_id(self, network, webhook_id):
+        """Set the alchemy webhook id of a network."""
+        self.webhook_ids[network] = webhook_id
+        self.record('set_webhook_id', network, webhook_id)
+
+    def get_tracking_wallets(self, network):
+        """Get all tracking addresses of a network with their notify tokens."""
+        return {decode_address(key): [self.tokens[handle] for handle in handles]
+                for key, handles in self.address_tokens.get(network, {}).items()}
+
+    def get_notify_tokens_by_address(self, network, address):
+        """Get the notify tokens of all users tracking an address, in any case."""
+        try:
+            key = encode_address(address)
+        except ValueError:
+            return []
+        return [self.tokens[handle] for handle in self.address_tokens.get(network, {}).get(key, ())]
+
+    def add_tracking_wallet(self, network, address, notify_token):
+        """Add a notify token to a tracking address."""
+        key = encode_address(address)
+        self.index_tracking_wallet(network, key, notify_token)
+        self.record('add_tracking_wallet', network, decode_address(key), notify_token)
+
+    def remove_tracking_wallet(self, network, address, notify_token):
+        """Remove a notify token from a tracking address."""
+        key = encode_address(address)
+        wallets = self.address_tokens.get(network, {})
+        handle = self.token_handles.get(notify_token)
+        handles = tuple(h for h in wallets.get(key, ()) if h != handle)
+        if handles:
+            wallets[key] = handles
+        else:
+            wallets.pop(key, None)
+        self.record('remove_tracking_wallet', network, decode_address(key), notify_token)
+
+    def get_notify_token_by_user_id(self, user_id):
+        """Get the notify token of a user."""
+        handle = self.user_tokens.get(user_id)
+        return None if handle is None else self.tokens[handle]
+
+    def set_notify_token_by_user_id(self, user_id, notify_token):
+        """Set the notify token of a user."""
+        self.user_tokens[user_id] = self.intern_token(notify_token)
+        self.record('set_notify_token_by_user_id', user_id, notify_token)
+
+    def get_tracking_addresses_by_user_id(self, user_id, network):
+        """Get the tracking addresses of a user."""
+        return [decode_address(key) for key in self.user_addresses.get((user_id, network), ())]
+
+    def add_tracking_address_by_user_id(self, user_id, network, address):
+        """Add a tracking address to a user."""
+        key = encode_address(address)
+        self.user_addresses.setdefault((user_id, network), {})[key] = None
+        self.record('add_tracking_address_by_user_id', user_id, network, decode_address(key))
+
+    def remove_tracking_address_by_user_id(self, user_id, network, address):
+        """Remove a tracking address from a user."""
+        key = encode_address(address)
+        addresses = self.user_addresses.get((user_id, network))
+        if addresses is not None:
+            addresses.pop(key, None)
+            if not addresses:
+                del self.user_addresses[(user_id, network)]
+        self.record('remove_tracking_address_by_user_id', user_id, network, decode_address(key))
+
+    def sync(self):
+        """Fsync the mutations appended to the journal since the last sync.
+
+        :return int: Number of mutations synced.
+        """
+        if self.journal is None:
+            return 0
+        with self.lock:
+            return self.journal.sync()
+
+    def compact(self):
+        """Write all queued mutations to the wallet database in one transaction, then drop them
+        from the journal.
+
+        The journal is rotated before writing, new mutations go to a fresh journal meanwhile.
+        If writing fails, the rotated journal is kept and will be replayed at next start.
+
+        :return int: Number of mutations written.
+        """
+        with self.compaction_lock:
+            with self.lock:
+                batch, self.pending = self.pending, []
+                if self.journal is not None:
+                    self.journal.rotate()
+            self.last_compaction = time.monotonic()
+            if not batch:
+                return 0
+            try:
+                wallet_store.apply_mutations(batch)
+            except Exception:
+                with self.lock:
+                    self.pending = batch + self.pending
+                raise
+            if self.journal is not None:
+                self.journal.discard_rotated()
+            return len(batch)
+
+    def flush(self):
+        """Sync the journal and compact it into the wallet database.
+
+        :return int: Number of mutations written to the wallet database.
+        """
+        self.sync()
+        return self.compact()
+
+    def stats(self):
+        """Get the statistics of the registry.
+
+        :rtype: dict
+        """
+        return {'tracking_addresses': sum(len(wallets) for wallets in self.address_tokens.values()),
+                'users': len(self.user_tokens),
+                'interned_tokens': len(self.tokens),
+                'pending_mutations': len(self.pending),
+                'unsynced_mutations': self.journal.unsynced if self.journal is not None else 0}
+
+
+registry = None
+
+
+def get_registry():
+    """Get the process-wide wallet registry, load it from the wallet database if not loaded.
+
+    Mutations left in the journal by the last run are replayed into the wallet database first.
+
+    :rtype: WalletRegistry
+    """
+    global registry
+    if registry is None:
+        mutation_journal = journal.MutationJournal(journal_path)
+        mutations = mutation_journal.replay()
+        if mutations:
+            wallet_store.apply_mutations(mutations)
+            mutation_journal.rotate()
+            mutation_journal.discard_rotated()
+            logging.info(f'Replayed {len(mutations)} journaled mutations into the wallet database.')
+        registry = WalletRegistry(mutation_journal)
+        registry.load(wallet_store.load_all())
+        atexit.register(registry.flush)
+    return registry
+
+
+async def run_flusher(sync_interval=1.0, compact_interval=60.0, compact_threshold=1000):
+    """Sync the journal every sync_interval seconds, and compact it into the wallet database every
+    compact_interval seconds or once compact_threshold mutations are queued, run forever.
+
+    :param float sync_interval: Seconds between two journal syncs.
+    :param float compact_interval: Max seconds between two compactions.
+    :param int compact_threshold: Number of queued mutations that triggers a compaction.
+    """
+    while True:
+        await asyncio.sleep(sync_interval)
+        wallet_registry = get_registry()
+        try:
+            await asyncio.to_thread(wallet_registry.sync)
+            if (len(wallet_registry.pending) >= compact_threshold
+                    or time.monotonic() - wallet_registry.last_compaction >= compact_interval):
+                await asyncio.to_thread(wallet_registry.compact)
+        except Exception as e:
+            logging.error(f'Failed to persist wallet registry, will retry: {e}')
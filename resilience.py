@@ -0,0 +1,94 @@
+"""This python file will keep upstream api calls bounded while the upstream is in trouble."""
+import logging
+import random
+import time
+
+
+class CircuitOpenError(Exception):
+    """Raised when a call is rejected because the circuit of the upstream is open."""
+
+
+class CircuitBreaker:
+    """Per-upstream circuit breaker.
+
+    After failure_threshold consecutive failures the circuit opens, and every call fails fast
+    without touching the upstream. Once reset_timeout seconds passed, one trial call is allowed,
+    the circuit closes again if it succeeds, otherwise it stays open for another reset_timeout.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        """Create a circuit breaker.
+
+        :param str name: Name of the upstream, used in logs.
+        :param int failure_threshold: Consecutive failures to open the circuit.
+        :param float reset_timeout: Seconds to wait before a trial call is allowed.
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0
+        self.trial_in_flight = False
+
+    def is_open(self):
+        """Check if calls will be rejected now, without taking the trial call.
+
+        :rtype: bool
+        """
+        if self.state == 'open':
+            return time.monotonic() - self.opened_at < self.reset_timeout
+        return self.state == 'half_open' and self.trial_in_flight
+
+    def check(self):
+        """Check if a call is allowed, raise CircuitOpenError if not."""
+        if self.state == 'open':
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError(f'Circuit of {self.name} is open')
+            self.state = 'half_open'
+            self.trial_in_flight = False
+        if self.state == 'half_open':
+            if self.trial_in_flight:
+                raise CircuitOpenError(f'Circuit of {self.name} is half open')
+            self.trial_in_flight = True
+
+    def record_success(self):
+        """Record a successful call, close the circuit if it's not closed."""
+        if self.state != 'closed':
+            logging.info(f'Circuit of {self.name} closed, upstream recovered.')
+        self.state = 'closed'
+        self.failures = 0
+        self.trial_in_flight = False
+
+    def release(self):
+        """Release the trial call without judging the upstream, e.g. when the call was cancelled."""
+        self.trial_in_flight = False
+
+    def record_failure(self):
+        """Record a failed call, open the circuit if there are too many failures."""
+        self.failures += 1
+        self.trial_in_flight = False
+        if self.state == 'half_open' or self.failures >= self.failure_threshold:
+            if self.state != 'open':
+                logging.warning(f'Circuit of {self.name} opened after {self.failures} failures, '
+                                f'calls will fail fast for {self.reset_timeout} seconds.')
+            self.state = 'open'
+            self.opened_at = time.monotonic()
+
+    def stats(self):
+        """Get the statistics of the circuit breaker.
+
+        :rtype: dict
+        """
+        return {'state': self.state, 'failures': self.failures}
+
+
+def backoff_delay(attempt, base=0.5, cap=30):
+    """Get the delay before the next retry, exponential backoff with full jitter.
+
+    :param int attempt: How many attempts have failed, start from 0.
+    :param float base: Delay of the first retry.
+    :param float cap: Max delay.
+    :rtype: float
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
@@ -0,0 +1,131 @@
+"""This python file will schedule upstream api calls under a rate limit."""
+import asyncio
+import itertools
+import time
+
+PRIORITY_VERIFY = 0
+PRIORITY_ENRICH = 1
+
+
+class TokenBucket:
+    """Token bucket rate limiter.
+
+    The bucket is refilled continuously by rate tokens per second, and can save up to capacity
+    tokens for bursts. Every call takes one token, or waits until one is refilled.
+    """
+
+    def __init__(self, rate, capacity=1):
+        """Create a token bucket.
+
+        :param float rate: Tokens refilled per second.
+        :param float capacity: Max tokens saved for bursts, default is 1, no burst. A full bucket
+            plus its refill lets about capacity + rate calls through within one second.
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def refill(self):
+        """Refill tokens by the time passed since the last refill."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self):
+        """Take one token, wait until it's refilled if the bucket is empty."""
+        while True:
+            self.refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class RequestScheduler:
+    """Process-wide scheduler in front of an upstream api.
+
+    Calls are queued by priority, lower number goes first, then dispatched one by one whenever the
+    token bucket allows, so the upstream is called right up to its quota but never past it.
+    """
+
+    def __init__(self, rate):
+        """Create a request scheduler.
+
+        The bucket saves no burst, calls are spaced 1 / rate seconds apart, so no one second window
+        goes past the per second limit of the upstream.
+
+        :param float rate: Max calls per second to the upstream.
+        """
+        self.bucket = TokenBucket(rate, capacity=1)
+        self.counter = itertools.count()
+        self.queue = None
+        self.loop = None
+        self.dispatcher = None
+        self.running_tasks = set()
+        self.dispatched = 0
+
+    async def submit(self, call, priority=PRIORITY_VERIFY):
+        """Queue a call and wait for its result.
+
+        :param call: Coroutine function without arguments, which calls the upstream.
+        :param int priority: Priority of the call, PRIORITY_VERIFY or PRIORITY_ENRICH.
+        :return: The result of the call.
+        """
+        self.start()
+        future = self.loop.create_future()
+        self.queue.put_nowait((priority, next(self.counter), call, future))
+        return await future
+
+    def start(self):
+        """Start the dispatcher in the running event loop if it's not started yet."""
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            self.loop = loop
+            self.queue = asyncio.PriorityQueue()
+            self.dispatcher = loop.create_task(self.dispatch())
+
+    async def dispatch(self):
+        """Dispatch queued calls under the rate limit, run forever."""
+        while True:
+            item = await self.queue.get()
+            await self.bucket.acquire()
+            # A more urgent call may be queued while waiting for the token
+            if not self.queue.empty():
+                head = self.queue.get_nowait()
+                if head < item:
+                    item, head = head, item
+                self.queue.put_nowait(head)
+            _, _, call, future = item
+            if future.cancelled():
+                continue
+            task = self.loop.create_task(self.run(call, future))
+            self.running_tasks.add(task)
+            task.add_done_callback(self.running_tasks.discard)
+
+    async def run(self, call, future):
+        """Run a dispatched call and pass its result to the waiting future."""
+        self.dispatched += 1
+        try:
+            result = await call()
+        except Exception as e:
+            if not future.cancelled():
+                future.set_exception(e)
+        else:
+            if not future.cancelled():
+                future.set_result(result)
+
+    def queue_depth(self):
+        """Get the number of calls waiting to be dispatched.
+
+        :rtype: int
+        """
+        return self.queue.qsize() if self.queue is not None else 0
+
+    def stats(self):
+        """Get the statistics of the scheduler.
+
+        :rtype: dict
+        """
+        return {'rate': self.bucket.rate, 'queue_depth': self.queue_depth(),
+                'in_flight': len(self.running_tasks), 'dispatched': self.dispatched}
@@ -0,0 +1,328 @@
+"""This python file will receive the activities of tracked wallets by Alchemy WebSockets.
+
+It's a lower latency alternative to the webhooks. Mined transactions from or to the tracked wallets
+and the Transfer logs of the tracked wallets are pushed as soon as Alchemy sees their block. They
+are converted to the activities of an ADDRESS_ACTIVITY webhook and queued in the same ingest queue
+as the webhooks, so they go through the same aggregation.
+
+The last block seen is remembered. After a reconnect, the blocks missed in between are backfilled
+by alchemy_getAssetTransfers, and activities seen twice are dropped. Internal transfers are not
+pushed by the subscriptions and only come with the backfill, keep the webhook for them.
+"""
+import asyncio
+import json
+import logging
+import time
+
+import websockets
+
+import cache
+import etherscan as eth
+import metadata_store
+import resilience
+
+# Max addresses in the filter of one subscription
+max_subscription_addresses = 1000
+
+
+def make_activity(txn_hash, block_number, from_address, to_address, category, raw_value,
+                  contract_address=None, decimals=None, asset=None, token_id=None, method_id=None):
+    """Make an activity in the format of an ADDRESS_ACTIVITY webhook.
+
+    :param str txn_hash: The hash of the transaction.
+    :param int block_number: The block number of the transaction.
+    :param str from_address: The sender.
+    :param str to_address: The receiver, None for a contract creation.
+    :param str category: external, internal or token.
+    :param int raw_value: Value in the smallest unit, wei for ETH.
+    :param str contract_address: The token contract, None for ETH.
+    :param int decimals: Decimals of the value, None if unknown, the value is left out then.
+    :param str asset: Symbol of the asset, ETH for ETH.
+    :param int token_id: Token id of an erc721 transfer.
+    :param str method_id: Method id of an external transaction, 0x if it has no calldata, None if
+        unknown.
+    :rtype: dict
+    """
+    activity = {'hash': txn_hash, 'blockNum': hex(block_number),
+                'fromAddress': from_address.lower(), 'toAddress': (to_address or '').lower(),
+                'category': category, 'asset': asset,
+                'rawContract': {'rawValue': hex(raw_value), 'address': contract_address,
+                                'decimals': decimals}}
+    if method_id is not None:
+        activity['methodId'] = method_id
+    if token_id is not None:
+        activity['erc721TokenId'] = hex(token_id)
+    elif decimals is not None:
+        # Without decimals the raw value can't be shown, it's left out like Alchemy does
+        activity['value'] = raw_value / 10 ** decimals
+    return activity
+
+
+def get_activity_key(activity):
+    """Get the key telling the same activity apart, whichever way it was received.
+
+    :param dict activity: The activity.
+    :rtype: tuple
+    """
+    return (activity['hash'], activity['category'], activity['fromAddress'],
+            activity['toAddress'], activity['rawContract']['address'],
+            activity.get('erc721TokenId') or activity['rawContract']['rawValue'])
+
+
+class AlchemyStream:
+    """WebSocket subscription of the tracked wallets of one network."""
+
+    def __init__(self, network, url, submit, get_addresses, refresh_interval=30,
+                 max_backfill_blocks=100):
+        """Create the stream.
+
+        :param str network: The network. (ETH_MAINNET or ETH_GOERLI)
+        :param str url: The WebSocket url of Alchemy.
+        :param submit: Function to queue a webhook payload.
+        :param get_addresses: Function to get the tracked addresses of the network.
+        :param float refresh_interval: Seconds between two checks of the tracked addresses, the
+            subscriptions are renewed when they change.
+        :param int max_backfill_blocks: Max blocks to backfill after a reconnect.
+        """
+        self.network = network
+        self.url = url
+        self.submit = submit
+        self.get_addresses = get_addresses
+        self.refresh_interval = refresh_interval
+        self.max_backfill_blocks = max_backfill_blocks
+        self.last_block = None
+        self.request_id = 0
+        self.subscriptions = {}
+        self.seen = cache.LRUCache(maxsize=100000, ttl=3600)
+        self.connects = 0
+        self.received = 0
+        self.backfilled = 0
+        self.duplicates = 0
+
+    async def run(self):
+        """Keep the subscription alive, reconnect with backoff, run forever."""
+        attempt = 0
+        while True:
+            try:
+                async with websockets.connect(self.url, max_size=None) as websocket:
+                    self.connects += 1
+                    attempt = 0
+                    await self.listen(websocket)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.warning(f'WebSocket of {self.network} disconnected: {e}')
+                await asyncio.sleep(resilience.backoff_delay(attempt))
+                attempt += 1
+
+    async def listen(self, websocket):
+        """Subscribe, backfill the blocks missed since the last connection, then handle the pushed
+        events until the tracked addresses change.
+
+        :param websocket: The connected WebSocket.
+        """
+        self.subscriptions = {}
+        addresses = sorted(address.lower() for address in self.get_addresses())
+        await self.subscribe(websocket, 'newHeads', ['newHeads'])
+        for i in range(0, len(addresses), max_subscription_addresses):
+            chunk = addresses[i:i + max_subscription_addresses]
+            await self.subscribe(websocket, 'minedTransactions', [
+                'alchemy_minedTransactions',
+                {'addresses': [{'from': address} for address in chunk] +
+                              [{'to': address} for address in chunk],
+                 'includeRemoved': False, 'hashesOnly': False}])
+            topics = ['0x' + address[2:].rjust(64, '0') for address in chunk]
+            await self.subscribe(websocket, 'logs',
+                                 ['logs', {'topics': [eth.transfer_topic, topics]}])
+            await self.subscribe(websocket, 'logs',
+                                 ['logs', {'topics': [eth.transfer_topic, None, topics]}])
+        if self.last_block is not None and addresses:
+            head = int(await self.request(websocket, 'eth_blockNumber', []), 16)
+            await self.backfill(websocket, set(addresses), self.last_block, head)
+        next_refresh = time.monotonic() + self.refresh_interval
+        while True:
+            try:
+                message = await asyncio.wait_for(websocket.recv(),
+                                                 max(next_refresh - time.monotonic(), 0))
+            except asyncio.TimeoutError:
+                if sorted(address.lower() for address in self.get_addresses()) != addresses:
+                    logging.info(f'Tracked addresses of {self.network} changed, resubscribing.')
+                    return
+                next_refresh = time.monotonic() + self.refresh_interval
+                continue
+            self.handle(json.loads(message))
+
+    async def request(self, websocket, method, params):
+        """Call a json-rpc method over the WebSocket, handle the events pushed meanwhile.
+
+        :param websocket: The connected WebSocket.
+        :param str method: The json-rpc method.
+        :param list params: The params of the method.
+        :return: The result of the call.
+        """
+        self.request_id += 1
+        request_id = self.request_id
+        await websocket.send(json.dumps({'jsonrpc': '2.0', 'id': request_id, 'method': method,
+                                         'params': params}))
+        while True:
+            message = json.loads(await websocket.recv())
+            if message.get('id') != request_id:
+                self.handle(message)
+                continue
+            if 'error' in message:
+                raise Exception(f"An error occurred while calling {method}: {message['error']}")
+            return message['result']
+
+    async def subscribe(self, websocket, kind, params):
+        """Start a subscription.
+
+        :param websocket: The connected WebSocket.
+        :param str kind: newHeads, minedTransactions or logs, how its events are handled.
+        :param list params: The params of eth_subscribe.
+        """
+        self.subscriptions[await self.request(websocket, 'eth_subscribe', params)] = kind
+
+    async def backfill(self, websocket, addresses, from_block, to_block):
+        """Queue the activities of the tracked addresses in the blocks missed while disconnected.
+
+        :param websocket: The connected WebSocket.
+        :param set addresses: The tracked addresses, in lower case.
+        :param int from_block: The last block seen, it may have been received partially.
+        :param int to_block: The current block.
+        """
+        if to_block - from_block > self.max_backfill_blocks:
+            logging.warning(f'Missed {to_block - from_block} blocks of {self.network}, only the '
+                            f'last {self.max_backfill_blocks} are backfilled.')
+            from_block = to_block - self.max_backfill_blocks
+        # Transfers are filtered by address on Alchemy, one address per side and query, the range
+        # may hold far too many transfers of the whole chain to page through
+        for address in sorted(addresses):
+            for side in ('fromAddress', 'toAddress'):
+                params = {'fromBlock': hex(from_block), 'toBlock': hex(to_block), side: address,
+                          'category': ['external', 'internal', 'erc20', 'erc721'],
+                          'excludeZeroValue': False, 'maxCount': hex(1000)}
+                while True:
+                    result = await self.request(websocket, 'alchemy_getAssetTransfers', [params])
+                    activities = [activity for activity in map(self.parse_asset_transfer,
+                                                               result['transfers'])
+                                  if activity is not None]
+                    self.backfilled += self.queue(activities)
+                    if not result.get('pageKey'):
+                        break
+                    params['pageKey'] = result['pageKey']
+        self.last_block = max(self.last_block, to_block)
+        logging.info(f'Backfilled {self.network} from block {from_block} to {to_block}.')
+
+    def handle(self, message):
+        """Handle an event pushed by a subscription.
+
+        :param dict message: The json-rpc notification.
+        """
+        if message.get('method') != 'eth_subscription':
+            return
+        kind = self.subscriptions.get(message['params']['subscription'])
+        result = message['params']['result']
+        if kind == 'newHeads':
+            self.set_last_block(int(result['number'], 16))
+            return
+        if kind == 'minedTransactions' and not result.get('removed'):
+            activity = self.parse_mined_transaction(result['transaction'])
+        elif kind == 'logs' and not result.get('removed'):
+            activity = self.parse_transfer_log(result)
+        else:
+            return
+        if activity is not None:
+            self.received += self.queue([activity])
+            self.set_last_block(int(activity['blockNum'], 16))
+
+    def set_last_block(self, block_number):
+        """Remember the last block seen.
+
+        :param int block_number: A block number seen.
+        """
+        if self.last_block is None or block_number > self.last_block:
+            self.last_block = block_number
+
+    def queue(self, activities):
+        """Queue the activities not seen before as an ADDRESS_ACTIVITY webhook payload.
+
+        :param list activities: The activities.
+        :return int: How many activities are queued.
+        """
+        new_activities = []
+        for activity in activities:
+            key = get_activity_key(activity)
+            if key in self.seen:
+                self.duplicates += 1
+                continue
+            self.seen.set(key, True)
+            new_activities.append(activity)
+        if new_activities:
+            self.submit({'type': 'ADDRESS_ACTIVITY',
+                         'event': {'network': self.network, 'activity': new_activities}})
+        return len(new_activities)
+
+    def parse_mined_transaction(self, txn):
+        """Parse a mined transaction into an external activity.
+
+        :param dict txn: The transaction of an alchemy_minedTransactions event.
+        :rtype: dict
+        """
+        return make_activity(txn['hash'], int(txn['blockNumber'], 16), txn['from'], txn['to'],
+                             'external', int(txn['value'], 16), decimals=18, asset='ETH',
+                             method_id=txn['input'][:10] if len(txn['input']) > 2 else '0x')
+
+    def parse_transfer_log(self, log):
+        """Parse a Transfer log into a token activity, named by the metadata store if known.
+
+        :param dict log: The log of a logs event.
+        :return dict: The activity, None if the log is not a Transfer event.
+        """
+        transfer = eth.decode_transfer_log(log)
+        if transfer is None:
+            return None
+        metadata = metadata_store.get_token_metadata(self.network, transfer['contractAddress'])
+        txn_hash, block_number = log['transactionHash'], int(log['blockNumber'], 16)
+        if transfer['txn_type'] == 'erc721':
+            return make_activity(txn_hash, block_number, transfer['from'], transfer['to'], 'token',
+                                 0, transfer['contractAddress'],
+                                 asset=metadata['name'] if metadata else None,
+                                 token_id=int(transfer['tokenID']))
+        return make_activity(txn_hash, block_number, transfer['from'], transfer['to'], 'token',
+                             int(transfer['value']), transfer['contractAddress'],
+                             decimals=metadata['decimals'] if metadata else None,
+                             asset=metadata['symbol'] if metadata else None)
+
+    def parse_asset_transfer(self, transfer):
+        """Parse a transfer of alchemy_getAssetTransfers into an activity.
+
+        :param dict transfer: The transfer.
+        :return dict: The activity, None if the category is not supported.
+        """
+        raw_contract = transfer['rawContract']
+        raw_value = int(raw_contract.get('value') or '0x0', 16)
+        block_number = int(transfer['blockNum'], 16)
+        if transfer['category'] in ('external', 'internal'):
+            return make_activity(transfer['hash'], block_number, transfer['from'], transfer['to'],
+                                 transfer['category'], raw_value, decimals=18, asset='ETH')
+        if transfer['category'] not in ('erc20', 'erc721'):
+            return None
+        contract_address = raw_contract['address'].lower()
+        if transfer['category'] == 'erc721':
+            return make_activity(transfer['hash'], block_number, transfer['from'], transfer['to'],
+                                 'token', 0, contract_address, asset=transfer['asset'],
+                                 token_id=int(transfer['erc721TokenId'], 16))
+        decimals = raw_contract.get('decimal')
+        return make_activity(transfer['hash'], block_number, transfer['from'], transfer['to'],
+                             'token', raw_value, contract_address,
+                             decimals=int(decimals, 16) if decimals else None,
+                             asset=transfer['asset'])
+
+    def stats(self):
+        """Get the statistics of the stream.
+
+        :rtype: dict
+        """
+        return {'connects': self.connects, 'last_block': self.last_block,
+                'received': self.received, 'backfilled': self.backfilled,
+                'duplicates': self.duplicates}
@@ -0,0 +1,63 @@
+"""This is a test file, and it has not been used in the production code.
+This file is used to manually measure the memory used by the wallet registry per tracked wallet.
+
+It compares the old layout of tracking_wallets.json (hex address strings with a list of notify
+token strings per wallet) with the registry indexes (20-byte address keys with interned notify
+token handles). Run it from the project root so the registry can be imported.
+"""
+import os
+import random
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import registry
+
+wallet_count = 100000
+user_count = 5000
+tokens_per_wallet = 2
+
+random.seed(0)
+tokens = [''.join(random.choices('abcdefghijklmnopqrstuvwxyz0123456789', k=43))
+          for _ in range(user_count)]
+# Addresses and tokens come from webhooks and json files as fresh strings, build them per wallet
+wallets = [('0x' + random.randbytes(20).hex(), random.sample(range(user_count), tokens_per_wallet))
+           for _ in range(wallet_count)]
+
+
+def measure(build):
+    """Measure the memory allocated by build.
+
+    :param build: Function building the structure to measure.
+    :return int: Bytes allocated and still held by the structure.
+    """
+    tracemalloc.start()
+    structure = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del structure
+    return size
+
+
+def build_json_layout():
+    data = {'ETH_MAINNET': {}}
+    for address, indexes in wallets:
+        data['ETH_MAINNET'][''.join(address)] = [''.join(tokens[i]) for i in indexes]
+    return data
+
+
+def build_registry():
+    wallet_registry = registry.WalletRegistry()
+    for address, indexes in wallets:
+        for i in indexes:
+            wallet_registry.index_tracking_wallet('ETH_MAINNET', registry.encode_address(address),
+                                                  ''.join(tokens[i]))
+    return wallet_registry
+
+
+before = measure(build_json_layout)
+after = measure(build_registry)
+print(f"{wallet_count} wallets, {user_count} users, {tokens_per_wallet} tokens per wallet")
+print(f"Before: {before / wallet_count:.1f} bytes per tracked wallet")
+print(f"After:  {after / wallet_count:.1f} bytes per tracked wallet")
@@ -0,0 +1,68 @@
+"""This is a test file, and it has not been used in the production code.
+This file is used to manually check that a token transfer found by hash can be notified.
+
+An ERC20 transfer of a contract already in the metadata store is built from the Transfer log of its
+receipt, without the token transfer list. The etherscan api is answered offline by canned proxy
+responses, then the row is found, formatted and sent by the erc20 template of LINE Notify.
+
+Run it from a directory with config.yml. Fill in your own line notify token at line 28 to receive
+the notification, otherwise the message is printed.
+"""
+import asyncio
+import os
+import sys
+import tempfile
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import etherscan as eth
+import line_notify
+import metadata_store
+
+test_wallet = '0x92a5148906d08254dfc9e4007ceaae37d8c3ddd9'
+other_wallet = '0x00000000219ab540356cbb839cbe05303d7705fa'
+token_contract = '0xa0b86991c6218b36c1d19d4a2e9eb0ce3606eb48'
+txn_hash = '0x' + '12' * 32
+test_notify_token = 'YOUR_TEST_LINE_NOTIFY_TOKEN'
+
+receipt = {'blockNumber': hex(17000000), 'gasUsed': hex(65000),
+           'effectiveGasPrice': hex(30 * 10 ** 9), 'contractAddress': None,
+           'logs': [{'address': token_contract,
+                     'topics': [eth.transfer_topic, '0x' + other_wallet[2:].rjust(64, '0'),
+                                '0x' + test_wallet[2:].rjust(64, '0')],
+                     'data': hex(25 * 10 ** 6)}]}
+# Canned etherscan responses by action
+responses = {'eth_getTransactionReceipt': {'jsonrpc': '2.0', 'id': 1, 'result': receipt},
+             'eth_getBlockByNumber': {'jsonrpc': '2.0', 'id': 1,
+                                      'result': {'timestamp': hex(1681000000)}},
+             'balance': {'status': '1', 'message': 'OK', 'result': str(10 ** 18)},
+             'tokenbalance': {'status': '1', 'message': 'OK', 'result': str(100 * 10 ** 6)}}
+
+
+def handle_request(request):
+    """Answer an etherscan api call by the canned response of its action."""
+    action = request.url.params['action']
+    if action not in responses:
+        return httpx.Response(200, json={'status': '0', 'message': 'NOTOK',
+                                         'result': f'Unexpected call of {action}'})
+    return httpx.Response(200, json=responses[action])
+
+
+async def main():
+    eth.async_client = httpx.AsyncClient(transport=httpx.MockTransport(handle_request))
+    metadata_store.save_token_metadata('ETH_MAINNET', token_contract, 'USDC', 6, 'USD Coin')
+    rows = await eth.async_find_transaction(txn_hash, test_wallet, {'erc20'}, 17000000)
+    assert 'gasPrice' in rows['erc20'], 'The token row has no gas'
+    txn = await eth.async_format_txn(rows['erc20'], 'erc20', test_wallet)
+    txn['spend_value'] = 'Transfer'
+    if test_notify_token == 'YOUR_TEST_LINE_NOTIFY_TOKEN':
+        line_notify.send_message = lambda message, token: print(message)
+    line_notify.send_notify(txn, 'erc20', [test_notify_token])
+    await eth.close_async_client()
+
+
+if __name__ == '__main__':
+    metadata_store.db_path = os.path.join(tempfile.mkdtemp(), 'metadata.db')
+    asyncio.run(main())
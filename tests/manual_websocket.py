@@ -0,0 +1,235 @@
+"""This is a test file, and it has not been used in the production code.
+This file is a local stand-in of the Alchemy WebSocket, used to test the websocket ingest mode
+offline.
+
+It mines a block every few seconds, with a swap of the test wallet (ETH sent, ETH received back by
+an internal transfer) and an ERC20 transfer received by it. The swap and the ERC20 transfer are
+pushed to the subscriptions of newHeads, alchemy_minedTransactions and logs. The internal transfer
+is not pushed over WebSockets, it's delivered a second later as an Alchemy webhook, like Alchemy
+does. The connections are dropped every few blocks, so the reconnection and the backfill of the
+missed blocks by alchemy_getAssetTransfers can be seen.
+
+Run `python tests/manual_websocket.py` from a directory with config.yml, then set ETH_MAINNET of
+alchemy_ws_urls to ws://localhost:8765 and ingest_mode to websocket in config.yml, track the test
+wallet by the Line bot, and run app.py. The webhooks are posted to the webhook_url of config.yml.
+Or run `python tests/manual_websocket.py --stream` to run the stream and the aggregation without
+the app, it prints every transaction flushed by the aggregation, such as normal+internal.
+"""
+import asyncio
+import itertools
+import json
+import os
+import sys
+import time
+
+import requests
+import websockets
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aggregator
+import utilities as utils
+
+test_wallet = '0x92a5148906d08254dfc9e4007ceaae37d8c3ddd9'
+other_wallet = '0x00000000219ab540356cbb839cbe05303d7705fa'
+token_contract = '0xa0b86991c6218b36c1d19d4a2e9eb0ce3606eb48'
+transfer_topic = '0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef'
+block_time = 3
+drop_every_blocks = 4
+webhook_delay = 1
+
+head = 17000000
+# Asset transfers of every mined block, answered by alchemy_getAssetTransfers
+history = []
+# Subscriptions of every connection
+connections = {}
+subscription_ids = itertools.count(1)
+
+
+def mine_block():
+    """Mine a block with a swap and an ERC20 transfer of the test wallet.
+
+    :return tuple: The block header, the mined transaction, the Transfer log and the webhook of the
+        internal transfer.
+    """
+    global head
+    head += 1
+    block_num = hex(head)
+    timestamp = time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime())
+    eth_hash = '0x' + f'{head:x}'.rjust(63, '0') + '1'
+    token_hash = '0x' + f'{head:x}'.rjust(63, '0') + '2'
+    header = {'number': block_num, 'timestamp': hex(int(time.time()))}
+    txn = {'hash': eth_hash, 'blockNumber': block_num, 'from': test_wallet, 'to': other_wallet,
+           'value': hex(10 ** 16), 'gasPrice': hex(30 * 10 ** 9),
+           'input': '0x7ff36ab5' + '0' * 64}
+    log = {'address': token_contract, 'blockNumber': block_num, 'transactionHash': token_hash,
+           'topics': [transfer_topic, '0x' + other_wallet[2:].rjust(64, '0'),
+                      '0x' + test_wallet[2:].rjust(64, '0')],
+           'data': hex(25 * 10 ** 6), 'removed': False}
+    history.append({'category': 'external', 'hash': eth_hash, 'blockNum': block_num,
+                    'from': test_wallet, 'to': other_wallet, 'asset': 'ETH', 'value': 0.01,
+                    'rawContract': {'value': hex(10 ** 16), 'address': None, 'decimal': '0x12'},
+                    'metadata': {'blockTimestamp': timestamp}})
+    history.append({'category': 'internal', 'hash': eth_hash, 'blockNum': block_num,
+                    'from': other_wallet, 'to': test_wallet, 'asset': 'ETH', 'value': 0.02,
+                    'rawContract': {'value': hex(2 * 10 ** 16), 'address': None, 'decimal': '0x12'},
+                    'metadata': {'blockTimestamp': timestamp}})
+    history.append({'category': 'erc20', 'hash': token_hash, 'blockNum': block_num,
+                    'from': other_wallet, 'to': test_wallet, 'asset': 'USDC', 'value': 25,
+                    'rawContract': {'value': hex(25 * 10 ** 6), 'address': token_contract,
+                                    'decimal': '0x6'},
+                    'metadata': {'blockTimestamp': timestamp}})
+    webhook = {'webhookId': 'wh_stand_in', 'id': f'whevt_{head}', 'type': 'ADDRESS_ACTIVITY',
+               'event': {'network': 'ETH_MAINNET', 'activity': [
+                   {'fromAddress': other_wallet, 'toAddress': test_wallet, 'blockNum': block_num,
+                    'hash': eth_hash, 'value': 0.02, 'asset': 'ETH', 'category': 'internal',
+                    'rawContract': {'rawValue': hex(2 * 10 ** 16), 'decimals': 18}}]}}
+    return header, txn, log, webhook
+
+
+def matches(kind, params, event):
+    """Check if an event matches the filter of a subscription.
+
+    :param str kind: newHeads, alchemy_minedTransactions or logs.
+    :param dict params: The filter of the subscription.
+    :param dict event: The event.
+    :rtype: bool
+    """
+    if kind == 'alchemy_minedTransactions':
+        return any(event['from'] == address.get('from') or event['to'] == address.get('to')
+                   for address in params.get('addresses', []))
+    if kind == 'logs':
+        for topic, wanted in zip(event['topics'], params.get('topics', [])):
+            wanted = wanted if isinstance(wanted, list) or wanted is None else [wanted]
+            if wanted is not None and topic not in wanted:
+                return False
+        return True
+    return True
+
+
+async def handle_connection(websocket):
+    """Answer the json-rpc calls of one connection."""
+    subscriptions = {}
+    connections[websocket] = subscriptions
+    print(f'Connected, head is {head}.')
+    try:
+        async for message in websocket:
+            request = json.loads(message)
+            method, params = request['method'], request['params']
+            if method == 'eth_subscribe':
+                subscription_id = hex(next(subscription_ids))
+                subscriptions[subscription_id] = (params[0], params[1] if len(params) > 1 else {})
+                result = subscription_id
+            elif method == 'eth_blockNumber':
+                result = hex(head)
+            elif method == 'alchemy_getAssetTransfers':
+                from_block = int(params[0]['fromBlock'], 16)
+                to_block = int(params[0]['toBlock'], 16)
+                result = {'transfers': [
+                    transfer for transfer in history
+                    if from_block <= int(transfer['blockNum'], 16) <= to_block
+                    and params[0].get('fromAddress', transfer['from']) == transfer['from']
+                    and params[0].get('toAddress', transfer['to']) == transfer['to']]}
+                print(f'Backfilled blocks {from_block} to {to_block}.')
+            else:
+                await websocket.send(json.dumps({'jsonrpc': '2.0', 'id': request['id'],
+                                                 'error': {'code': -32601,
+                                                           'message': 'Method not found'}}))
+                continue
+            await websocket.send(json.dumps({'jsonrpc': '2.0', 'id': request['id'],
+                                             'result': result}))
+    except websockets.ConnectionClosed:
+        pass
+    finally:
+        connections.pop(websocket, None)
+
+
+async def run_miner(deliver_webhook):
+    """Mine blocks, push their events, drop the connections every few blocks.
+
+    :param deliver_webhook: Awaitable function to deliver the webhook of the internal transfer.
+    """
+    while True:
+        await asyncio.sleep(block_time)
+        *block_events, webhook = mine_block()
+        events = dict(zip(('newHeads', 'alchemy_minedTransactions', 'logs'), block_events))
+        asyncio.get_running_loop().call_later(
+            webhook_delay, lambda webhook=webhook: asyncio.create_task(deliver_webhook(webhook)))
+        if head % drop_every_blocks == 0:
+            print(f'Mined block {head}, dropping the connections.')
+            for websocket in list(connections):
+                await websocket.close()
+            continue
+        print(f'Mined block {head}.')
+        for websocket, subscriptions in list(connections.items()):
+            for subscription_id, (kind, params) in subscriptions.items():
+                if kind in events and matches(kind, params, events[kind]):
+                    result = events[kind]
+                    if kind == 'alchemy_minedTransactions':
+                        result = {'removed': False, 'transaction': result}
+                    await websocket.send(json.dumps({
+                        'jsonrpc': '2.0', 'method': 'eth_subscription',
+                        'params': {'subscription': subscription_id, 'result': result}}))
+
+
+async def post_webhook(webhook):
+    """Post a webhook to the app, like Alchemy does."""
+    url = utils.read_config()['webhook_url'] + '/alchemy'
+    response = await asyncio.to_thread(requests.post, url, json=webhook, timeout=5)
+    print(f'Posted the webhook of the internal transfer: {response.status_code}')
+
+
+class LocalAggregation:
+    """The aggregation stage of app.py, printing the transactions it flushes."""
+
+    def __init__(self):
+        self.txn_buckets = aggregator.TxnBuckets()
+
+    def submit(self, payload):
+        """Classify and aggregate a payload, like process_alchemy_webhook."""
+        txns = aggregator.classify_activities(
+            payload['event']['network'], payload['event']['activity'],
+            lambda network, address: ['test'] if address == test_wallet else [])
+        for txn in txns:
+            if self.txn_buckets.add(txn):
+                print(f"Received {txn['txn_type']} {txn['txn_hash']}")
+        for key in dict.fromkeys(aggregator.get_key(txn) for txn in txns):
+            if self.txn_buckets.claim(key):
+                asyncio.create_task(self.flush(key))
+
+    async def flush(self, key):
+        """Wait the window of a transaction, then print its merged types."""
+        await self.txn_buckets.wait_window(key)
+        types = dict.fromkeys(txn['txn_type'] for txn in self.txn_buckets.pop(key))
+        print(f"Flushed {'+'.join(types)} {key[1]}")
+
+    async def deliver_webhook(self, webhook):
+        """Deliver a webhook straight to the aggregation."""
+        self.submit(webhook)
+
+
+async def run_stream(local_aggregation):
+    """Run the stream of the websocket ingest mode against this stand-in.
+
+    :param LocalAggregation local_aggregation: The aggregation fed by the stream.
+    """
+    import stream
+
+    alchemy_stream = stream.AlchemyStream('ETH_MAINNET', 'ws://localhost:8765',
+                                          local_aggregation.submit, lambda: [test_wallet])
+    await asyncio.sleep(1)
+    await alchemy_stream.run()
+
+
+async def main():
+    async with websockets.serve(handle_connection, 'localhost', 8765):
+        if '--stream' in sys.argv:
+            local_aggregation = LocalAggregation()
+            await asyncio.gather(run_miner(local_aggregation.deliver_webhook),
+                                 run_stream(local_aggregation))
+        else:
+            await run_miner(post_webhook)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
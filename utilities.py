@@ -1,44 +1,24 @@
 """This python will handle some extra functions."""
-import json
-import os
 import sys
 from os.path import exists
 
-import requests
 import yaml
 from yaml import SafeLoader
 
+import registry
+
 
 def initial_checks():
     import alchemy
 
-    if not exists('./tracking_wallets.json'):
-        print("Wallet tracking list not found, creating one by default.")
-        eth_id = alchemy.create_address_activity_webhook('ETH_MAINNET')
-        eth_goerli_id = alchemy.create_address_activity_webhook('ETH_GOERLI')
-        with open('tracking_wallets.json', 'w', encoding="utf8") as file:
-            file.write("""{
-        "ETH_MAINNET": {
-            "webhook_id": "%s"
-            },
-        "ETH_GOERLI": {
-            "webhook_id": "%s"
-            }
-        }""" % (eth_id, eth_goerli_id))
-        file.close()
-    if not exists('./notify_token_pairs.json'):
-        print("Line user_id to notify_token pairs file not found, creating one by default.")
-        with open('notify_token_pairs.json', 'w', encoding="utf8") as file:
-            file.write("{}")
-        file.close()
-    if not exists('./user_tracking_list.json'):
-        print("User tracking list not found, creating one by default.")
-        with open('user_tracking_list.json', 'w', encoding="utf8") as file:
-            file.write("""{
-        "ETH_MAINNET": {},
-        "ETH_GOERLI": {}
-        }""")
-        file.close()
+    if not registry.get_registry().get_webhook_id('ETH_MAINNET'):
+        print("Alchemy webhooks not found, creating them by default.")
+        wallet_registry = registry.get_registry()
+        wallet_registry.set_webhook_id('ETH_MAINNET',
+                                       alchemy.create_address_activity_webhook('ETH_MAINNET'))
+        wallet_registry.set_webhook_id('ETH_GOERLI',
+                                       alchemy.create_address_activity_webhook('ETH_GOERLI'))
+        wallet_registry.flush()
 
 
 def config_file_generator():
@@ -73,6 +53,55 @@ line_channel_access_token: ''
 line_channel_secret: ''
 line_notify_id: ''
 line_notify_secret: ''
+
+# Performance tuning, you can leave these as default.
+# Max number of pooled keep-alive connections used to call Etherscan.
+etherscan_pool_size: 10
+# Max number of Etherscan api calls per second, it depends on your api key plan.
+etherscan_rate_limit: 5
+# Seconds to wait for one Etherscan api call, and how many times a failed call will be retried.
+etherscan_timeout: 10
+etherscan_max_retries: 4
+# Max disk space of cached NFT images, and max size of one image to download, in MB.
+image_cache_size_mb: 500
+image_max_size_mb: 10
+# Max width and height of NFT images sent by LINE Notify, and processes used to resize them.
+line_image_max_px: 1024
+image_process_workers: 2
+# Seconds to wait for more activities of a transaction from Alchemy after its last activity,
+# seconds to wait instead once it has the types of the largest merges (normal+erc20+erc721 or
+# normal+internal+erc20) or it's a plain ETH transfer seen by the WebSocket, and max seconds in
+# total.
+aggregation_window: 2
+aggregation_min_window: 0.5
+aggregation_max_window: 5
+# Max number of Alchemy webhooks queued in memory, more are spilled to disk until the queue drains,
+# and number of workers processing the queue.
+ingest_queue_size: 1000
+ingest_workers: 4
+# Seconds to remember received webhooks and notified transactions, to drop retried deliveries.
+idempotency_ttl: 3600
+# Notify mode, verified waits for Etherscan to send the full notification,
+# fast sends a short one from the Alchemy webhook right away, then the full one as a follow-up
+# if fast_notify_followup is true.
+notify_mode: 'verified'
+fast_notify_followup: true
+# Backend to verify transactions of each network, etherscan or alchemy.
+# alchemy finds every tracked wallet of a block by one alchemy_getAssetTransfers call.
+verification_backends:
+  ETH_MAINNET: 'etherscan'
+  ETH_GOERLI: 'etherscan'
+# Ask the other backend as well when a verification takes longer than this percentile of the
+# recent latencies of its backend, the first one finding the transaction wins. 0 disables it.
+hedge_percentile: 95
+# Ingest mode, webhook only receives the Alchemy webhooks, websocket also subscribes to the tracked
+# wallets by Alchemy WebSockets for lower latency. Internal transfers still come from the webhook.
+ingest_mode: 'webhook'
+# WebSocket url of each network to subscribe to instead of Alchemy, such as a local server for
+# testing.
+alchemy_ws_urls:
+  ETH_MAINNET: ''
+  ETH_GOERLI: ''
 """
                    )
         file.close()
@@ -104,7 +133,29 @@ def read_config():
                 'line_channel_access_token': data['line_channel_access_token'],
                 'line_channel_secret': data['line_channel_secret'],
                 'line_notify_id': data['line_notify_id'],
-                'line_notify_secret': data['line_notify_secret']
+                'line_notify_secret': data['line_notify_secret'],
+                'etherscan_pool_size': data.get('etherscan_pool_size', 10),
+                'etherscan_rate_limit': data.get('etherscan_rate_limit', 5),
+                'etherscan_timeout': data.get('etherscan_timeout', 10),
+                'etherscan_max_retries': data.get('etherscan_max_retries', 4),
+                'image_cache_size_mb': data.get('image_cache_size_mb', 500),
+                'image_max_size_mb': data.get('image_max_size_mb', 10),
+                'line_image_max_px': data.get('line_image_max_px', 1024),
+                'image_process_workers': data.get('image_process_workers', 2),
+                'aggregation_window': data.get('aggregation_window', 2),
+                'aggregation_min_window': data.get('aggregation_min_window', 0.5),
+                'aggregation_max_window': data.get('aggregation_max_window', 5),
+                'ingest_queue_size': data.get('ingest_queue_size', 1000),
+                'ingest_workers': data.get('ingest_workers', 4),
+                'idempotency_ttl': data.get('idempotency_ttl', 3600),
+                'notify_mode': data.get('notify_mode', 'verified'),
+                'fast_notify_followup': data.get('fast_notify_followup', True),
+                'verification_backends': {'ETH_MAINNET': 'etherscan', 'ETH_GOERLI': 'etherscan',
+                                          **(data.get('verification_backends') or {})},
+                'hedge_percentile': data.get('hedge_percentile', 95),
+                'ingest_mode': data.get('ingest_mode', 'webhook'),
+                'alchemy_ws_urls': {'ETH_MAINNET': '', 'ETH_GOERLI': '',
+                                    **(data.get('alchemy_ws_urls') or {})}
             }
             file.close()
             return config
@@ -116,58 +167,58 @@ def read_config():
 
 
 def get_tracking_wallets(network):
-    """Get tracking wallets from tracking_wallets.json.
+    """Get tracking wallets from the wallet registry.
 
-    This is the file that saved all the tracking info's from alchemy webhooks.
-    Structure of the file should start with a network_type key and the value should be a dict.
-    The dict should contain a webhook_id key value pair, then the address key should return a list
+    This is where all the tracking info's from alchemy webhooks are saved.
+    Building this dict walks every tracking address, use get_notify_tokens_by_address for lookups.
+    The returned dict contains a webhook_id key value pair, then the address key returns a list
     of line_notify_token values.
 
     :param str network: The network of the target. (ETH_MAINNET or ETH_GOERLI)
     :return dict: Tracking wallets of the network.
     """
-    data = json.load(open('tracking_wallets.json', encoding="utf8"))
-    return data[network]
+    data = {'webhook_id': registry.get_registry().get_webhook_id(network)}
+    data.update(registry.get_registry().get_tracking_wallets(network))
+    return data
 
 
-def add_tracking_wallet(network, address, notify_token):
-    """Add tracking wallet to tracking_wallets.json.
+def get_webhook_id(network):
+    """Get the alchemy webhook id of a network.
+
+    :param str network: The network of the webhook. (ETH_MAINNET or ETH_GOERLI)
+    :return str: The webhook id.
+    """
+    return registry.get_registry().get_webhook_id(network)
+
+
+def get_notify_tokens_by_address(network, address):
+    """Get line notify tokens of all users tracking the address.
+
+    :param str network: The network of the target. (ETH_MAINNET or ETH_GOERLI)
+    :param str address: The tracking address.
+    :return list: The notify tokens, empty if the address is not tracked.
+    """
+    return registry.get_registry().get_notify_tokens_by_address(network, address)
 
-    This is the file that saved all the tracking info's from alchemy webhooks.
-    Structure of the file should start with a network_type key and the value should be a dict.
-    The dict should contain a webhook_id key value pair, then the address key should return a list
-    of line_notify_token values.
+
+def add_tracking_wallet(network, address, notify_token):
+    """Add tracking wallet to the wallet registry.
 
     :param str network: The network of the target. (ETH_MAINNET or ETH_GOERLI)
     :param str address: The address to add.
     :param str notify_token: The notify token of the user.
     """
-    data = json.load(open('tracking_wallets.json', encoding="utf8"))
-    if address not in data[network]:
-        data[network][address] = [notify_token]
-    else:
-        data[network][address].append(notify_token)
-    update_json('tracking_wallets.json', data)
+    registry.get_registry().add_tracking_wallet(network, address, notify_token)
 
 
 def remove_tracking_wallet(network, address, notify_token):
-    """Remove tracking wallet from tracking_wallets.json.
-
-    This is the file that saved all the tracking info's from alchemy webhooks.
-    Structure of the file should start with a network_type key and the value should be a dict.
-    The dict should contain a webhook_id key value pair, then the address key should return a list
-    of line_notify_token values.
+    """Remove tracking wallet from the wallet registry.
 
     :param str network: The network of the target. (ETH_MAINNET or ETH_GOERLI)
     :param str address: The address to remove.
     :param str notify_token: The notify token of the user.
     """
-    data = json.load(open('tracking_wallets.json', encoding="utf8"))
-    if len(data[network][address]) == 1:
-        data[network].pop(address)
-    else:
-        data[network][address].remove(notify_token)
-    update_json('tracking_wallets.json', data)
+    registry.get_registry().remove_tracking_wallet(network, address, notify_token)
 
 
 def add_notify_token_by_user_id(user_id, notify_token):
@@ -176,9 +227,7 @@ def add_notify_token_by_user_id(user_id, notify_token):
     :param str user_id: The user id of the user.
     :param str notify_token: The notify token of the user.
     """
-    data = json.load(open('notify_token_pairs.json', encoding="utf8"))
-    data[user_id] = notify_token
-    update_json('notify_token_pairs.json', data)
+    registry.get_registry().set_notify_token_by_user_id(user_id, notify_token)
 
 
 def get_notify_token_by_user_id(user_id):
@@ -187,76 +236,59 @@ def get_notify_token_by_user_id(user_id):
     :param str user_id: The user id of the user.
     :return str: The notify token of the user.
     """
-    data = json.load(open('notify_token_pairs.json', encoding="utf8"))
-    if user_id not in data:
-        return None
-    return data[user_id]
+    return registry.get_registry().get_notify_token_by_user_id(user_id)
 
 
 def get_tracking_addresses_by_user_id(user_id, network):
-    """Get tracking addresses by line user id from user_tracking_list.json.
-
-    This is the file that saved all tracking addresses based on a line user id.
-    Structure of the file should start with a network_type key and the value should be a dict.
-    The dict should contain a line user id as key, and a list of addresses as value.
+    """Get tracking addresses by line user id from the wallet registry.
 
     :param str user_id: The line user id of the user.
     :param str network: Network type you would like to search.
     :return list: The list of tracking addresses.
     """
-    data = json.load(open('user_tracking_list.json', encoding="utf8"))
-    if user_id not in data[network]:
-        return []
-    return data[network][user_id]
+    return registry.get_registry().get_tracking_addresses_by_user_id(user_id, network)
 
 
 def add_tracking_address_by_user_id(user_id, network, address):
-    """Add tracking address by line user id to user_tracking_list.json.
-
-    This is the file that saved all tracking addresses based on a line user id.
-    Structure of the file should start with a network_type key and the value should be a dict.
-    The dict should contain a line user id as key, and a list of addresses as value.
+    """Add tracking address by line user id to the wallet registry.
 
     :param str user_id: The line user id of the user.
     :param str network: The network of the address.
     :param str address: The address to add.
     """
-    data = json.load(open('user_tracking_list.json', encoding="utf8"))
-    if user_id not in data[network]:
-        data[network][user_id] = [address]
-    else:
-        data[network][user_id].append(address)
-    update_json('user_tracking_list.json', data)
+    registry.get_registry().add_tracking_address_by_user_id(user_id, network, address)
 
 
 def remove_tracking_address_by_user_id(user_id, network, address):
-    """Remove tracking address by line user id from user_tracking_list.json.
-
-    This is the file that saved all tracking addresses based on a line user id.
-    Structure of the file should start with a network_type key and the value should be a dict.
-    The dict should contain a line user id as key, and a list of addresses as value.
+    """Remove tracking address by line user id from the wallet registry.
 
     :param str user_id: The line user id of the user.
     :param str network: The network of the address.
     :param str address: The address to remove.
     """
-    data = json.load(open('user_tracking_list.json', encoding="utf8"))
-    if len(data[network][user_id]) == 1:
-        data[network].pop(user_id)
-    else:
-        data[network][user_id].remove(address)
-    update_json('user_tracking_list.json', data)
+    registry.get_registry().remove_tracking_address_by_user_id(user_id, network, address)
 
 
-def update_json(file, data):
-    """Update a json file.
+def get_network(goerli=False):
+    """Get the network name used by alchemy and the tracking files.
 
-    :param str file: The file to update.
-    :param dict data: The data to update.
+    :param bool goerli: If True, use goerli testnet, default is False
+    :rtype: str
     """
-    with open(file, 'w', encoding="utf8") as file:
-        json.dump(data, file, indent=4)
-        file.close()
+    return 'ETH_GOERLI' if goerli else 'ETH_MAINNET'
+
+
+def is_valid_address(address):
+    """Check if a string is a 20-byte hex wallet address with 0x prefix.
+
+    :param str address: The string to check.
+    :rtype: bool
+    """
+    try:
+        registry.encode_address(address)
+    except ValueError:
+        return False
+    return True
 
 
 def wei_to_eth(wei):
@@ -277,21 +309,21 @@ def wei_to_gwei(wei):
     return int(round(wei / 10 ** 9, 0))
 
 
-def download_png_from_url(folder_name, url, filename):
-    """Download png from given url.
+def create_async_client(pool_size, headers=None):
+    """Create a pooled keep-alive async http client.
 
-    Use to download NFT's image.
+    HTTP/2 will be used when the h2 package is installed, otherwise HTTP/1.1 keep-alive.
 
-    :param str folder_name: Folder name of downloaded files.
-    :param url: url of file
-    :param filename: filename of file
-    :return str: file path
+    :param int pool_size: Max number of connections kept in the pool.
+    :param dict headers: Default headers of every request.
+    :rtype: httpx.AsyncClient
     """
-    r = requests.get(url, allow_redirects=True, timeout=5)
-    path = f'./images/nft_images/{folder_name}'
-    if not os.path.exists(path):
-        os.makedirs(path)
-    file_path = f'{path}/{filename}.png'
-    with open(file_path, 'wb') as fd:
-        fd.write(r.content)
-    return file_path
+    import httpx
+
+    try:
+        import h2  # noqa: F401
+        http2 = True
+    except ImportError:
+        http2 = False
+    limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+    return httpx.AsyncClient(headers=headers, limits=limits, http2=http2)
@@ -0,0 +1,208 @@
+"""This python file will verify the transactions received from Alchemy on Etherscan.
+
+Etherscan sees a transaction a few seconds after Alchemy reports it, so the transaction has to be
+polled until it shows up. Pending transactions are grouped by (network, wallet, block), and one
+poller looks every hash of a group up once, resolving all types of the hash at the same time.
+Lookups are keyed by hash, so a poll costs the same no matter how busy the wallet is. Polls are
+scheduled by the lag measured on Etherscan, and back off exponentially while the transactions are
+still missing.
+
+Every network is verified on Etherscan by default, or on Alchemy, which lists the transfers of a
+whole block once for every tracked wallet in it. Slow lookups are hedged by the other provider.
+"""
+import asyncio
+import logging
+import time
+
+import providers
+
+
+class PendingGroup:
+    """Transactions of one wallet in one block waiting to be found on Etherscan."""
+
+    def __init__(self, next_poll):
+        self.registered_at = time.monotonic()
+        self.next_poll = next_poll
+        self.attempts = 0
+        self.polling = False
+        # (txn_type, txn_hash) -> futures waiting for the row
+        self.waiters = {}
+
+
+class VerificationPoller:
+    """Shared poller of the pending transactions, grouped by (network, wallet, block)."""
+
+    def __init__(self, min_delay=1, max_delay=30, max_wait=600, alpha=0.2, network_backends=None,
+                 hedge_percentile=95):
+        """Create the poller.
+
+        :param float min_delay: Min seconds between two polls of a group.
+        :param float max_delay: Max seconds between two polls of a group.
+        :param float max_wait: Seconds before a transaction not found is given up.
+        :param float alpha: Weight of the latest measured lag in the moving average.
+        :param dict network_backends: Name of the backend by network, default is etherscan.
+        :param float hedge_percentile: Percentile of the latencies of a backend to wait before
+            asking the other backend as well, 0 disables hedging.
+        """
+        for backend in (network_backends or {}).values():
+            if backend not in providers.find_functions:
+                raise Exception(f'Unknown verification backend {backend}, use one of '
+                                f'{", ".join(providers.find_functions)}')
+        self.network_backends = network_backends or {}
+        self.providers = providers.HedgedProviders(percentile=hedge_percentile)
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.max_wait = max_wait
+        self.alpha = alpha
+        self.groups = {}
+        self.lags = {}
+        self.wakeup = None
+        self.queries = 0
+        self.resolved = 0
+        self.expired = 0
+
+    def get_wakeup(self):
+        """Get the event waking the poller up, create it in the running event loop if needed.
+
+        :rtype: asyncio.Event
+        """
+        if self.wakeup is None:
+            self.wakeup = asyncio.Event()
+        return self.wakeup
+
+    def get_delay(self, network, attempts):
+        """Get the seconds to wait before the next poll of a group.
+
+        The first poll waits the measured indexing lag of the network, later polls back off
+        exponentially from it.
+
+        :param str network: The network of the group.
+        :param int attempts: Polls of the group so far.
+        :rtype: float
+        """
+        lag = self.lags.get(network, 0)
+        if attempts == 0:
+            return min(lag, self.max_delay)
+        return min(max(lag / 2, self.min_delay) * 2 ** (attempts - 1), self.max_delay)
+
+    async def wait_for(self, network, wallet, block_num, txn_type, txn_hash):
+        """Wait until a transaction is found on Etherscan.
+
+        :param str network: The network of the transaction. (ETH_MAINNET or ETH_GOERLI)
+        :param str wallet: The target wallet address of the transaction.
+        :param int block_num: The block number of the transaction.
+        :param str txn_type: normal, internal, erc20 or erc721.
+        :param str txn_hash: The hash of the transaction.
+        :return dict: The transaction row returned by Etherscan.
+        :raises TimeoutError: If the transaction is not found in max_wait seconds.
+        """
+        key = (network, wallet, block_num)
+        group = self.groups.get(key)
+        if group is None:
+            group = self.groups[key] = PendingGroup(time.monotonic() + self.get_delay(network, 0))
+        future = asyncio.get_running_loop().create_future()
+        group.waiters.setdefault((txn_type, txn_hash), []).append(future)
+        self.get_wakeup().set()
+        return await future
+
+    async def run(self):
+        """Poll the groups when they are due, run forever."""
+        wakeup = self.get_wakeup()
+        while True:
+            wakeup.clear()
+            now = time.monotonic()
+            next_poll = None
+            for key, group in self.groups.items():
+                if group.polling:
+                    continue
+                if group.next_poll <= now:
+                    group.polling = True
+                    asyncio.create_task(self.poll(key, group))
+                elif next_poll is None or group.next_poll < next_poll:
+                    next_poll = group.next_poll
+            try:
+                await asyncio.wait_for(wakeup.wait(),
+                                       None if next_poll is None else next_poll - now)
+            except asyncio.TimeoutError:
+                pass
+
+    async def poll(self, key, group):
+        """Look every hash of a group up concurrently, then reschedule or drop the group.
+
+        :param tuple key: (network, wallet, block_num) of the group.
+        :param PendingGroup group: The group.
+        """
+        network, wallet, block_num = key
+        try:
+            txn_types = {}
+            for txn_type, txn_hash in group.waiters:
+                txn_types.setdefault(txn_hash, set()).add(txn_type)
+            self.queries += len(txn_types)
+            backend = self.network_backends.get(network, 'etherscan')
+            results = await asyncio.gather(
+                *(self.providers.find_transaction(backend, txn_hash, wallet, types, block_num,
+                                                  goerli=network == 'ETH_GOERLI')
+                  for txn_hash, types in txn_types.items()), return_exceptions=True)
+            for txn_hash, rows in zip(txn_types, results):
+                if isinstance(rows, Exception):
+                    logging.warning(f'Failed to look {txn_hash} up, will retry: {rows}')
+                    continue
+                self.resolve(network, group, txn_hash, rows)
+        finally:
+            group.polling = False
+            group.attempts += 1
+            self.reschedule(key, group)
+            self.get_wakeup().set()
+
+    def resolve(self, network, group, txn_hash, rows):
+        """Resolve the waiters of a group whose transaction types are found.
+
+        :param str network: The network of the group.
+        :param PendingGroup group: The group.
+        :param str txn_hash: The hash of the transaction.
+        :param dict rows: Found transaction rows by type.
+        """
+        for txn_type, row in rows.items():
+            for future in group.waiters.pop((txn_type, txn_hash), []):
+                if not future.done():
+                    future.set_result(dict(row))
+                    self.resolved += 1
+            lag = time.monotonic() - group.registered_at
+            self.lags[network] = (lag if network not in self.lags
+                                  else self.alpha * lag + (1 - self.alpha) * self.lags[network])
+
+    def reschedule(self, key, group):
+        """Drop the group if nothing is waiting on it or it's expired, otherwise schedule its
+        next poll.
+
+        :param tuple key: (network, wallet, block_num) of the group.
+        :param PendingGroup group: The group.
+        """
+        for waiter_key in [k for k, futures in group.waiters.items()
+                           if all(future.done() for future in futures)]:
+            del group.waiters[waiter_key]
+        now = time.monotonic()
+        if group.waiters and now - group.registered_at > self.max_wait:
+            for futures in group.waiters.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(TimeoutError(f'{key} not found on etherscan'))
+                        self.expired += 1
+            group.waiters.clear()
+        if not group.waiters:
+            if self.groups.get(key) is group:
+                del self.groups[key]
+            return
+        group.next_poll = now + self.get_delay(key[0], group.attempts)
+
+    def stats(self):
+        """Get the statistics of the poller.
+
+        :rtype: dict
+        """
+        return {'pending_groups': len(self.groups), 'queries': self.queries,
+                'backends': {network: self.network_backends.get(network, 'etherscan')
+                             for network in ('ETH_MAINNET', 'ETH_GOERLI')},
+                'resolved': self.resolved, 'expired': self.expired,
+                'providers': self.providers.get_stats(),
+                'indexing_lag': {network: round(lag, 3) for network, lag in self.lags.items()}}
@@ -0,0 +1,150 @@
+"""This python file will save the tracking wallets, user tracking lists and notify tokens.
+
+Everything is saved in a SQLite file in WAL mode, indexed by network and address for webhooks
+and by user id for bot commands, so every change only touches the rows it needs.
+The database is loaded into the in-memory registry once at start, and changes of the registry are
+written back in batches. The old json files will be migrated into the database at the first start.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+db_path = './wallets.db'
+json_files = {'tracking_wallets': './tracking_wallets.json',
+              'user_tracking_list': './user_tracking_list.json',
+              'notify_token_pairs': './notify_token_pairs.json'}
+connection = None
+lock = threading.RLock()
+
+
+def get_connection():
+    """Get the connection of the wallet database, create the tables and migrate if needed.
+
+    :rtype: sqlite3.Connection
+    """
+    global connection
+    with lock:
+        if connection is None:
+            connection = sqlite3.connect(db_path, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.executescript("""
+                CREATE TABLE IF NOT EXISTS webhooks (
+                    network TEXT PRIMARY KEY,
+                    webhook_id TEXT NOT NULL);
+                CREATE TABLE IF NOT EXISTS tracking_wallets (
+                    network TEXT NOT NULL,
+                    address TEXT NOT NULL,
+                    notify_token TEXT NOT NULL,
+                    PRIMARY KEY (network, address, notify_token));
+                CREATE TABLE IF NOT EXISTS user_tracking (
+                    user_id TEXT NOT NULL,
+                    network TEXT NOT NULL,
+                    address TEXT NOT NULL,
+                    PRIMARY KEY (user_id, network, address));
+                CREATE TABLE IF NOT EXISTS notify_tokens (
+                    user_id TEXT PRIMARY KEY,
+                    notify_token TEXT NOT NULL);
+                """)
+            connection.commit()
+            migrate_json_files(connection)
+            lowercase_addresses(connection)
+    return connection
+
+
+def migrate_json_files(conn):
+    """Migrate the old json files into the database, then rename them with .migrated suffix.
+
+    Addresses are saved in lowercase, like the registry writes them.
+
+    :param sqlite3.Connection conn: Connection of the wallet database.
+    """
+    if not any(os.path.exists(path) for path in json_files.values()):
+        return
+    with conn:
+        if os.path.exists(json_files['tracking_wallets']):
+            with open(json_files['tracking_wallets'], encoding="utf8") as file:
+                data = json.load(file)
+            for network, wallets in data.items():
+                for address, notify_tokens in wallets.items():
+                    if address == 'webhook_id':
+                        conn.execute('INSERT OR REPLACE INTO webhooks VALUES (?, ?)',
+                                     (network, notify_tokens))
+                        continue
+                    conn.executemany('INSERT OR IGNORE INTO tracking_wallets VALUES (?, ?, ?)',
+                                     [(network, address.lower(), token)
+                                      for token in notify_tokens])
+        if os.path.exists(json_files['user_tracking_list']):
+            with open(json_files['user_tracking_list'], encoding="utf8") as file:
+                data = json.load(file)
+            for network, users in data.items():
+                for user_id, addresses in users.items():
+                    conn.executemany('INSERT OR IGNORE INTO user_tracking VALUES (?, ?, ?)',
+                                     [(user_id, network, address.lower())
+                                      for address in addresses])
+        if os.path.exists(json_files['notify_token_pairs']):
+            with open(json_files['notify_token_pairs'], encoding="utf8") as file:
+                data = json.load(file)
+            conn.executemany('INSERT OR REPLACE INTO notify_tokens VALUES (?, ?)', data.items())
+    for path in json_files.values():
+        if os.path.exists(path):
+            os.replace(path, f'{path}.migrated')
+    logging.info('Migrated tracking json files into the wallet database.')
+
+
+def lowercase_addresses(conn):
+    """Lowercase the addresses migrated in their original case by older versions.
+
+    The registry writes changes with lowercase addresses, so a mixed case row would never be
+    removed. Rows that become duplicates are dropped.
+
+    :param sqlite3.Connection conn: Connection of the wallet database.
+    """
+    with conn:
+        for table in ('tracking_wallets', 'user_tracking'):
+            conn.execute(f'UPDATE OR IGNORE {table} SET address = lower(address) '
+                         f'WHERE address != lower(address)')
+            conn.execute(f'DELETE FROM {table} WHERE address != lower(address)')
+
+
+def load_all():
+    """Load every row of the wallet database, used to build the in-memory registry.
+
+    :return dict: Rows of webhooks, tracking_wallets, user_tracking and notify_tokens tables.
+    """
+    with lock:
+        conn = get_connection()
+        return {
+            'webhooks': conn.execute('SELECT network, webhook_id FROM webhooks').fetchall(),
+            'tracking_wallets': conn.execute(
+                'SELECT network, address, notify_token FROM tracking_wallets '
+                'ORDER BY rowid').fetchall(),
+            'user_tracking': conn.execute(
+                'SELECT user_id, network, address FROM user_tracking ORDER BY rowid').fetchall(),
+            'notify_tokens': conn.execute(
+                'SELECT user_id, notify_token FROM notify_tokens').fetchall()}
+
+
+def apply_mutations(mutations):
+    """Apply a batch of registry mutations in one transaction.
+
+    Every mutation is a tuple of an operation name and its arguments, the operations are
+    set_webhook_id, add_tracking_wallet, remove_tracking_wallet, set_notify_token_by_user_id,
+    add_tracking_address_by_user_id and remove_tracking_address_by_user_id.
+
+    :param list mutations: Mutations to apply, in the order they happened.
+    """
+    statements = {
+        'set_webhook_id': 'INSERT OR REPLACE INTO webhooks VALUES (?, ?)',
+        'add_tracking_wallet': 'INSERT OR IGNORE INTO tracking_wallets VALUES (?, ?, ?)',
+        'remove_tracking_wallet': 'DELETE FROM tracking_wallets '
+                                  'WHERE network = ? AND address = ? AND notify_token = ?',
+        'set_notify_token_by_user_id': 'INSERT OR REPLACE INTO notify_tokens VALUES (?, ?)',
+        'add_tracking_address_by_user_id': 'INSERT OR IGNORE INTO user_tracking VALUES (?, ?, ?)',
+        'remove_tracking_address_by_user_id': 'DELETE FROM user_tracking '
+                                              'WHERE user_id = ? AND network = ? AND address = ?'}
+    with lock, get_connection() as conn:
+        for operation, *args in mutations:
+            conn.execute(statements[operation], args)